@@ -3,7 +3,7 @@
 from Tkinter import *
 from globals import *
 from utility import *
-from graphing import single_axis_graph, multi_axis_graph
+from graphing import single_axis_graph, multi_axis_graph, load_line_graph, map_graph, sample_curves
 from data_element import data_element
 from tube_map import tube_map
 from range import range
@@ -32,6 +32,8 @@ class action_type(object) :
 
 class plot_action(action_type) :
 
+    SAMPLE_SIZE = (CANVAS_WIDTH, CANVAS_HEIGHT)     # pixels to sample curves for, see graphing.sample_curves
+
     def __init__(self, parent_frame, button_frame, get_tube_map) :
         super(plot_action, self).__init__(parent_frame, button_frame)
         self.get_tube_map = get_tube_map
@@ -43,6 +45,35 @@ class plot_action(action_type) :
             self.button_frame.show('Configure')
         super(plot_action, self).install()
 
+    def plot(self) :
+        tm = self.get_tube_map()
+        params = self.plot_params()
+        return self.make_graph(tm, params, self.compute(tm, params))
+
+    def plot_params(self) :
+        """
+        Read the parameters for the plot from the display. This must be
+        done in the main (Tk) thread.
+        """
+        return {}
+
+    def compute(self, tm, params) :
+        """
+        Calculate the curves, as arrays ready to plot. This does no Tk or
+        matplotlib calls, so that it can be run in a background thread (see
+        plot_worker), and make_graph has nothing left to evaluate.
+        """
+        return None
+
+    def make_graph(self, tm, params, result, previous=None, figure=None) :
+        """
+        Make the graph from the result of compute(). If previous is given
+        (the graph from the last plot) it is reused if possible, otherwise
+        the new one is drawn on the same figure, or on figure if that's
+        given (see graph_base.make).
+        """
+        return None
+
     def get_tm_data(self, fn) :
         if self.get_tube_map() :
             return fn(self.get_tube_map())
@@ -67,9 +98,7 @@ class plate_action(plot_action) :
                       ('min_vg', 'max_vg'),
                       ('min_ia', 'max_ia'),))
 
-    def plot(self) :
-        curves = []
-        labels = []
+    def plot_params(self) :
         d = self.data
         x_values = range(d['min_va'], d['max_va'])
         y_axis = range(d['min_ia'], d['max_ia'])
@@ -77,13 +106,18 @@ class plate_action(plot_action) :
             vg_values = range(d['min_vg'], d['max_vg'])
         else :
             vg_values = self.get_tube_map().vg_values()
-        for vg in vg_values :
-            curves.append([self.get_tube_map()(va, vg) for va in x_values])
-            labels.append("Vg = %.1f" % (vg,))
-        graph = single_axis_graph(x_values=x_values, y_values=curves, labels=labels, x_label="Va",
-                                  y_label="Ia (mA)", y_axis=y_axis,
-                                  title=self.get_tube_map().title, subtitle=u"Plate Curves")
-        graph.finish()
+        return { 'x_values' : x_values, 'y_axis' : y_axis, 'vg_values' : vg_values }
+
+    def compute(self, tm, params) :
+        return sample_curves(tm.plate_curves(list(params['vg_values'])), params['x_values'], params['y_axis'],
+                             size=plot_action.SAMPLE_SIZE)
+
+    def make_graph(self, tm, params, curves, previous=None, figure=None) :
+        labels = ["Vg = %.1f" % (vg,) for vg in params['vg_values']]
+        x, y = curves
+        graph = single_axis_graph.make(previous, figure, x_values=x, y_values=y, sampled=True,
+                                       labels=labels, x_label="Va", y_label="Ia (mA)", y_axis=params['y_axis'],
+                                       title=tm.title, subtitle=u"Plate Curves")
         return graph
 
 class grid_action(plot_action) :
@@ -104,9 +138,7 @@ class grid_action(plot_action) :
                       ('min_va', 'max_va'),
                       ('min_ia', 'max_ia'),))
 
-    def plot(self) :
-        curves = []
-        labels = []
+    def plot_params(self) :
         d = self.data
         x_values = range(d['min_vg'], d['max_vg'])
         y_axis = range(d['min_ia'], d['max_ia'])
@@ -114,13 +146,18 @@ class grid_action(plot_action) :
             va_values = range(d['min_va'], d['max_va'])
         else :
             va_values = self.get_tube_map().va_values()
-        for va in va_values :
-            curves.append([self.get_tube_map()(va, vg) for vg in x_values])
-            labels.append("Va = %.0f" % (va,))
-        graph = single_axis_graph(x_values=x_values, y_values=curves, labels=labels, x_label="Vg",
-                                  y_label="Ia (mA)", y_axis=y_axis,
-                                  title=self.get_tube_map().title, subtitle=u"Grid Curves")
-        graph.finish()
+        return { 'x_values' : x_values, 'y_axis' : y_axis, 'va_values' : va_values }
+
+    def compute(self, tm, params) :
+        return sample_curves(tm.grid_curves(list(params['va_values'])), params['x_values'], params['y_axis'],
+                             size=plot_action.SAMPLE_SIZE)
+
+    def make_graph(self, tm, params, curves, previous=None, figure=None) :
+        labels = ["Va = %.0f" % (va,) for va in params['va_values']]
+        x, y = curves
+        graph = single_axis_graph.make(previous, figure, x_values=x, y_values=y, sampled=True,
+                                       labels=labels, x_label="Vg", y_label="Ia (mA)", y_axis=params['y_axis'],
+                                       title=tm.title, subtitle=u"Grid Curves")
         return graph
 
 class deriv_action(plot_action) :
@@ -140,7 +177,7 @@ class deriv_action(plot_action) :
                           ('show_va_vg', '?Show Va & Vg')),
             format = (('min_ia', 'max_ia'), ('va',), ('vg',), ('eb', 'rl'), ('show_va_vg',)))
 
-    def plot(self) :
+    def plot_params(self) :
         eb = va = vg = rl = 0
         d = self.data
         method = d.get_radio_value()
@@ -154,14 +191,142 @@ class deriv_action(plot_action) :
         else :                  # must be 'va'
             va = d['va']
             note = "Va = %.0f V" % (va,)
-        derivs = self.get_tube_map().get_derivatives(Eb=eb, Va=va, Vg=vg, Rl=rl, Ia=ia)
+        return { 'eb' : eb, 'va' : va, 'vg' : vg, 'rl' : rl, 'ia' : ia, 'note' : note,
+                 'show_va_vg' : d['show_va_vg'] }
+
+    def compute(self, tm, params) :
+        p = params
+        ia_range, fn = tm.derivative_curves(Eb=p['eb'], Va=p['va'], Vg=p['vg'], Rl=p['rl'], Ia=p['ia'])
+        count = 5 if p['show_va_vg'] else 3
+        return sample_curves(lambda ia: fn(ia)[:count], list(ia_range), separate=True, size=plot_action.SAMPLE_SIZE)
+
+    def make_graph(self, tm, params, derivs, previous=None, figure=None) :
         labels = ["Gm (mA/V)", u"Rp (KΩ)", u"µ"]
-        if d['show_va_vg'] :
+        if params['show_va_vg'] :
             labels += ["Va", "Vg"]
-        graph = multi_axis_graph(x_values=derivs[0], y_values=derivs[1:len(labels) + 1],
-                                 labels=labels, x_label="Ia (ma)", title=self.get_tube_map().title,
-                                 subtitle=u"Gm, Rp and µ", note=note)
-        graph.finish()
+        x, y = derivs
+        graph = multi_axis_graph.make(previous, figure, x_values=x, y_values=y, sampled=True,
+                                      labels=labels, x_label="Ia (ma)", title=tm.title,
+                                      subtitle=u"Gm, Rp and µ", note=params['note'])
+        return graph
+
+class loadline_action(plot_action) :
+    """
+    Plate curves with a load line over them, set by sliders for Eb, Rl and
+    the grid bias, showing the operating point and gm, rp and mu there.
+    Moving a slider calls live_plot (set by the main panel), which should
+    call update_point() and redraw just the overlay if this action's graph
+    is showing, or otherwise plot it.
+    """
+
+    SLIDER_LENGTH = 250
+
+    def __init__(self, parent_frame, button_frame, get_tube_map) :
+        super(loadline_action, self).__init__(parent_frame, button_frame, get_tube_map)
+        self.live_plot = None
+        self.graph = None
+        self.sliders = {}
+        for name, label, resolution in (('eb', 'Eb (V)', 1), ('rl', u'Rl (KΩ)', 0.1), ('vg', 'Vg (V)', 0.05)) :
+            self.sliders[name] = Scale(self.frame, label=label, orient=HORIZONTAL, resolution=resolution,
+                                       length=loadline_action.SLIDER_LENGTH, bg=BGCOL_BG,
+                                       command=self.slider_change)
+        self.reset_data()
+
+    def reset_data(self) :
+        self.graph = None
+        self.data = data_element(self.frame,
+            attributes = (('max_va', 'Max Va', { 'dflt':round(self.get_tm_data(tube_map.va_max), 2) }),
+                          ('max_ia', 'Max Ia', { 'dflt':round(self.get_tm_data(tube_map.ia_max), 2) })),
+            format = (('max_va', 'max_ia'),))
+        va_max = self.get_tm_data(tube_map.va_max) or 1
+        vg_min = self.get_tm_data(tube_map.vg_min)
+        ia_max = self.get_tm_data(tube_map.ia_max) or 1
+        eb = round(va_max * tube_map.EB_RATIO, 2)
+        for name, low, high, value in (('eb', 0, va_max, eb),
+                                       ('rl', 0.1, 10 * eb / ia_max, 2 * eb / ia_max),
+                                       ('vg', vg_min, 0, vg_min / 2)) :
+            self.sliders[name].config(from_=low, to=high)
+            self.sliders[name].set(value)
+
+    def install(self) :
+        super(loadline_action, self).install()
+        row = len(self.data.display_format)
+        for n, name in enumerate(('eb', 'rl', 'vg')) :
+            self.sliders[name].grid(row=row + n, column=0, columnspan=4, sticky=W)
+
+    def slider_change(self, value) :
+        if self.live_plot and self.get_tube_map() :
+            self.live_plot(self)
+
+    def slider_values(self) :
+        return [ float(self.sliders[name].get()) for name in ('eb', 'rl', 'vg') ]
+
+    def plot_params(self) :
+        d = self.data
+        return { 'x_values' : range(0, d['max_va']), 'y_axis' : range(0, d['max_ia']),
+                 'vg_values' : self.get_tube_map().vg_values() }
+
+    def compute(self, tm, params) :
+        return sample_curves(tm.plate_curves(list(params['vg_values'])), params['x_values'], params['y_axis'],
+                             size=plot_action.SAMPLE_SIZE)
+
+    def make_graph(self, tm, params, curves, previous=None, figure=None) :
+        labels = ["Vg = %.1f" % (vg,) for vg in params['vg_values']]
+        x, y = curves
+        self.graph = load_line_graph.make(previous, figure, x_values=x, y_values=y, sampled=True,
+                                          labels=labels, x_label="Va", y_label="Ia (mA)", y_axis=params['y_axis'],
+                                          title=tm.title, subtitle=u"Load Line")
+        self.update_point(tm)
+        return self.graph
+
+    def update_point(self, tm) :
+        """
+        Move the load line and operating point to the current slider values.
+        """
+        eb, rl, vg = self.slider_values()
+        va, ia, failed = tm.load_line_point(eb, rl, vg)
+        gm, rp, mu = tm.derivatives(va, vg)
+        text = u"Va = %.1f V  Ia = %.2f mA  Vg = %.2f V\ngm = %.2f mA/V  rp = %.2f KΩ  µ = %.1f" % \
+               (va, ia, vg, gm, rp, mu)
+        self.graph.set_operating_point([0, eb], [eb / rl, 0], float(va), float(ia), text)
+
+class map_action(plot_action) :
+    """
+    gm, rp or mu over the whole Va x Vg plane, from the tube's derivative
+    map (see tube_map.derivative_map), as a heatmap or as contours. The
+    radio button chooses the quantity; a non-zero maximum fixes the top
+    of its colour scale.
+    """
+
+    LABELS = { 'gm' : ("Gm (mA/V)", u"Gm Map"), 'rp' : (u"Rp (KΩ)", u"Rp Map"), 'mu' : (u"µ", u"µ Map") }
+
+    def __init__(self, parent_frame, button_frame, get_tube_map) :
+        super(map_action, self).__init__(parent_frame, button_frame, get_tube_map)
+        self.reset_data()
+
+    def reset_data(self) :
+        self.data = data_element(self.frame,
+            attributes = (('gm', '*Gm max', { 'dflt':0 }),
+                          ('rp', '*Rp max', { 'dflt':0 }),
+                          ('mu', '*Mu max', { 'dflt':0 }),
+                          ('contours', '?Contours')),
+            format = (('gm',), ('rp',), ('mu',), ('contours',)))
+
+    def plot_params(self) :
+        d = self.data
+        quantity = d.get_radio_value() or 'gm'
+        return { 'quantity' : quantity, 'z_max' : d[quantity], 'contours' : d['contours'] }
+
+    def compute(self, tm, params) :
+        return tm.derivative_map()
+
+    def make_graph(self, tm, params, dmap, previous=None, figure=None) :
+        label, subtitle = map_action.LABELS[params['quantity']]
+        graph = map_graph.make(previous, figure, x_values=dmap.va, y_values=dmap.vg,
+                               z_values=getattr(dmap, params['quantity']), mask=dmap.mask,
+                               z_axis=(0, params['z_max']) if params['z_max'] else None,
+                               contours=params['contours'], x_label="Va", y_label="Vg", z_label=label,
+                               title=tm.title, subtitle=subtitle)
         return graph
 
 class config_action(action_type) :
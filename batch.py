@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import itertools
+import multiprocessing
+from utracer_data import utracer_data
+from tube_map import tube_map
+from catalog import tube_catalog
+
+class batch_result(object) :
+    """
+    The outcome of loading one file: either tube_map (or, if only the
+    models were wanted, model - the filename of the saved model) is set,
+    or error describes what went wrong. elapsed is the time taken by the
+    worker.
+    """
+
+    def __init__(self, filename, tube_map=None, model=None, error=None, elapsed=0) :
+        self.filename, self.tube_map, self.model, self.error, self.elapsed = \
+            filename, tube_map, model, error, elapsed
+
+    def __str__(self) :
+        if self.error :
+            return "%-24s error: %s" % (self.filename, self.error)
+        return "%-24s %6.3f s %s" % (self.filename, self.elapsed, self.model or '')
+
+def tube_files(paths) :
+    """
+    Expand a list of files and directories into the sweep files they contain.
+    """
+    result = []
+    for p in paths :
+        if os.path.isdir(p) :
+            result += sorted([ os.path.join(p, f) for f in os.listdir(p)
+                               if f.endswith(tube_catalog.EXTENSIONS) ])
+        else :
+            result.append(p)
+    return result
+
+def load_tube(filename, models_only=False) :
+    """
+    Parse and fit one file, returning a batch_result. This is what the
+    workers run, so any error is caught and reported in the result.
+    """
+    start = time.time()
+    try :
+        tm = tube_map(utracer_data(filename), tube_catalog.make_title(filename))
+        if models_only :
+            tm.save(tm.model_filename())
+            return batch_result(filename, model=tm.model_filename(), elapsed=time.time() - start)
+        return batch_result(filename, tube_map=tm, elapsed=time.time() - start)
+    except Exception as exc :
+        return batch_result(filename, error='%s: %s' % (type(exc).__name__, exc), elapsed=time.time() - start)
+
+def _load_tube(args) :
+    return load_tube(*args)
+
+def _init_worker(use_cache) :
+    utracer_data.use_cache = tube_map.use_cache = use_cache
+
+class worker_pool(object) :
+    """
+    A pool of worker processes for jobs items of work, by default one per
+    CPU, which follow this process's cache settings. With only one worker
+    there is no pool and the work is just done here. Use it in a with
+    statement: at the end the workers are left to finish, or stopped if
+    anything went wrong (including a generator using it being abandoned).
+    """
+
+    def __init__(self, workers=None, jobs=None) :
+        workers = min(workers or multiprocessing.cpu_count(), jobs or 1)
+        self.pool = multiprocessing.Pool(workers, _init_worker, (utracer_data.use_cache and tube_map.use_cache,)) \
+                    if workers > 1 else None
+
+    def map(self, fn, items) :
+        return self.pool.map(fn, items) if self.pool else map(fn, items)
+
+    def imap(self, fn, items) :
+        return self.pool.imap(fn, items) if self.pool else itertools.imap(fn, items)
+
+    def imap_unordered(self, fn, items) :
+        return self.pool.imap_unordered(fn, items) if self.pool else itertools.imap(fn, items)
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) :
+        if self.pool :
+            if exc_type is None :
+                self.pool.close()
+            else :
+                self.pool.terminate()
+            self.pool.join()
+
+def load_tubes(paths, workers=None, models_only=False) :
+    """
+    Load and fit all the sweep files in paths (files or directories) using a
+    pool of worker processes, by default one per CPU. Yields a batch_result
+    for each file, in the order they finish. An error in one file is reported
+    in its result and doesn't stop the others. If models_only is set, the
+    workers just save the fitted models (see tube_map.save) and the results
+    give their filenames, which saves sending the tube_maps back.
+    """
+    files = tube_files(paths)
+    with worker_pool(workers, len(files)) as pool :
+        for r in pool.imap_unordered(_load_tube, [ (f, models_only) for f in files ]) :
+            yield r
+
+# Stand-alone use: load the given files and directories, reporting the time
+# taken for each one and for the whole batch.
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    parser = ArgumentParser(usage='[options] file-or-directory...')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('-m', '--models-only', action='store_true', help="Just save the fitted models")
+    parser.add_argument('-C', '--no-cache', action='store_true', help="Don't use or write parsed data and model caches")
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    if args.no_cache :
+        utracer_data.use_cache = tube_map.use_cache = False
+    start = time.time()
+    count = errors = 0
+    for r in load_tubes(args.paths, workers=args.workers, models_only=args.models_only) :
+        print r
+        count += 1
+        errors += bool(r.error)
+    print "%d files, %d errors, %.3f s" % (count, errors, time.time() - start)
+    sys.exit(1 if errors else 0)
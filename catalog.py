@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import fnmatch
+from utracer_data import utracer_data
+from tube_map import tube_map
+from utility import write_cache
+
+class tube_catalog(object) :
+    """
+    An index of the uTracer sweep files in a data directory, kept in a file
+    (tube_index.json) in the same directory. Each record holds the tube type,
+    the Va, Vg and Ia ranges, the number of Va and Vg points and the content
+    hash, so that tubes can be listed and chosen without parsing every file.
+
+    refresh() brings the index up to date: files whose mtime and size are
+    unchanged are skipped, changed files are re-hashed and only re-read if
+    their content has changed, and records for deleted files are dropped.
+    Files that can't be parsed get a record with an 'error' entry, so that
+    they aren't retried until they change.
+    """
+
+    INDEX_NAME = 'tube_index.json'
+    INDEX_VERSION = 1
+    EXTENSIONS = ('.txt', '.utd')
+
+    def __init__(self, directory, refresh=True) :
+        self.directory = directory
+        self.records = {}
+        self._load()
+        if refresh :
+            self.refresh()
+
+    def index_filename(self) :
+        return os.path.join(self.directory, tube_catalog.INDEX_NAME)
+
+    def _load(self) :
+        try :
+            with open(self.index_filename(), 'r') as f :
+                index = json.load(f)
+            if index.get('version') == tube_catalog.INDEX_VERSION :
+                self.records = index['records']
+        except (IOError, OSError, ValueError, KeyError) :
+            self.records = {}
+
+    def save(self) :
+        write_cache(self._write_index)
+
+    def _write_index(self) :
+        temp = self.index_filename() + '.tmp'
+        with open(temp, 'w') as f :
+            json.dump({ 'version' : tube_catalog.INDEX_VERSION, 'records' : self.records },
+                      f, indent=1, sort_keys=True)
+        if os.path.exists(self.index_filename()) :
+            os.remove(self.index_filename())
+        os.rename(temp, self.index_filename())
+
+    def refresh(self) :
+        """
+        Update the index from the directory, and save it if anything changed.
+        Returns the number of records added, updated and removed.
+        """
+        added = updated = 0
+        present = set()
+        for f in sorted(os.listdir(self.directory)) :
+            if not f.endswith(tube_catalog.EXTENSIONS) :
+                continue
+            present.add(f)
+            path = os.path.join(self.directory, f)
+            st = os.stat(path)
+            old = self.records.get(f)
+            if old and (old['mtime'], old['size']) == (st.st_mtime, st.st_size) :
+                continue
+            record = self._make_record(f, path, old)
+            record['mtime'], record['size'] = st.st_mtime, st.st_size
+            self.records[f] = record
+            if old :
+                updated += 1
+            else :
+                added += 1
+        removed = [ f for f in self.records if f not in present ]
+        for f in removed :
+            del self.records[f]
+        if added or updated or removed :
+            self.save()
+        return (added, updated, len(removed))
+
+    def _make_record(self, filename, path, old) :
+        title = tube_catalog.make_title(filename)
+        try :
+            udata = utracer_data(path)
+            if old and old.get('hash') == udata.content_hash :
+                return dict(old)        # same content, only the mtime has changed
+            tm = tube_map(udata, title)
+        except (ValueError, IndexError) as exc :
+            return { 'filename' : filename, 'title' : title, 'error' : str(exc) }
+        return { 'filename' : filename,
+                 'title' : title,
+                 'hash' : udata.content_hash,
+                 'va_range' : [ float(v) for v in tm.va_range() ],
+                 'vg_range' : [ float(v) for v in tm.vg_range() ],
+                 'ia_range' : [ float(v) for v in tm.ia_range() ],
+                 'va_points' : len(tm.va_values()),
+                 'vg_points' : len(tm.vg_values()) }
+
+    @staticmethod
+    def make_title(filename) :
+        return os.path.basename(filename).split('.')[0].upper()
+
+    def find(self, pattern=None, va=None, vg=None, ia=None) :
+        """
+        Return the records, sorted by title, for tubes whose title matches
+        the pattern and whose data covers the given Va, Vg and Ia. The
+        pattern is case-insensitive and may use shell wildcards, otherwise
+        it matches any part of the title.
+        """
+        result = []
+        for r in self.records.itervalues() :
+            if 'error' in r or not tube_catalog._matches(r, pattern) :
+                continue
+            if any(v is not None and not (rng[0] <= v <= rng[1]) for v, rng in
+                   ((va, r['va_range']), (vg, r['vg_range']), (ia, r['ia_range']))) :
+                continue
+            result.append(r)
+        return sorted(result, key=lambda r: (r['title'], r['filename']))
+
+    def errors(self, pattern=None) :
+        """
+        Return the records for files that couldn't be read, see find().
+        """
+        return sorted([ r for r in self.records.itervalues()
+                        if 'error' in r and tube_catalog._matches(r, pattern) ],
+                      key=lambda r: r['filename'])
+
+    @staticmethod
+    def _matches(record, pattern) :
+        if not pattern :
+            return True
+        if not re.search(r'[*?\[]', pattern) :
+            pattern = '*' + pattern + '*'
+        return fnmatch.fnmatch(record['title'], pattern.upper())
+
+    def open(self, record, model=tube_map) :
+        """
+        Return the tube_map for a record (or the filename of one). model is
+        the class to use, e.g. koren_map.
+        """
+        if isinstance(record, basestring) :
+            record = self.records[os.path.basename(record)]
+        return model(utracer_data(os.path.join(self.directory, record['filename'])), record['title'])
+
+    @staticmethod
+    def describe(record) :
+        return "%-12s %-18s Va %4.0f-%4.0f V  Vg %6.1f-%5.1f V  Ia %6.2f-%6.2f mA  %3d x %2d" % \
+               ((record['title'], record['filename']) + tuple(record['va_range'])
+                + tuple(record['vg_range']) + tuple(record['ia_range'])
+                + (record['va_points'], record['vg_points']))
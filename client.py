@@ -0,0 +1,110 @@
+#!/usr/bin/python
+import sys
+import json
+import httplib
+from server import DEFAULT_PORT
+
+class query_error(Exception) :
+    pass
+
+class tube_client(object) :
+    """
+    Client for server.py. The connection is kept open between requests.
+    The query methods return the result as a dict of values (lists for
+    array arguments), and raise query_error if the server reports one.
+    batch() sends several queries in one request and returns the results
+    as they are, including any errors.
+    """
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, timeout=30) :
+        self.host, self.port, self.timeout = host, port, timeout
+        self.connection = None
+
+    def request(self, method, path, value=None) :
+        body = json.dumps(value) if value is not None else None
+        for attempt in (0, 1) :
+            if self.connection is None :
+                self.connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try :
+                self.connection.request(method, path, body, { 'Content-Type' : 'application/json' })
+                response = self.connection.getresponse()
+                result = json.loads(response.read())
+                break
+            except (httplib.HTTPException, IOError) :
+                self.close()
+                if attempt :            # retry once, in case the server closed an idle connection
+                    raise
+        if response.status != 200 :
+            raise query_error(result.get('error', response.reason))
+        return result
+
+    def close(self) :
+        if self.connection is not None :
+            self.connection.close()
+            self.connection = None
+
+    def batch(self, queries) :
+        return self.request('POST', '/query', queries)
+
+    def query(self, tube, op, **kwargs) :
+        kwargs.update(tube=tube, op=op)
+        result = self.request('POST', '/query', kwargs)
+        if 'error' in result :
+            raise query_error(result['error'])
+        return result
+
+    def ia(self, tube, Va, Vg) :
+        return self.query(tube, 'ia', Va=Va, Vg=Vg)['Ia']
+
+    def derivatives(self, tube, Va, Vg) :
+        return self.query(tube, 'derivatives', Va=Va, Vg=Vg)
+
+    def load_line(self, tube, Eb, Rl=0, **kwargs) :
+        return self.query(tube, 'load_line', Eb=Eb, Rl=Rl, **kwargs)
+
+    def Vg_from_Ia(self, tube, Va, Ia) :
+        return self.query(tube, 'Vg_from_Ia', Va=Va, Ia=Ia)['Vg']
+
+    def Va_from_Ia(self, tube, Vg, Ia) :
+        return self.query(tube, 'Va_from_Ia', Vg=Vg, Ia=Ia)['Va']
+
+    def info(self, tube) :
+        return self.query(tube, 'info')
+
+    def tubes(self) :
+        return self.request('GET', '/tubes')
+
+    def stats(self) :
+        return self.request('GET', '/stats')
+
+# Stand-alone use: send one query, given as name=value arguments (values are
+# JSON, so lists can be given as e.g. Va=[100,200]), and print the result.
+#
+#   python client.py 6sn7 ia Va=250 Vg=-4
+#   python client.py 6sn7 load_line Eb=250 Rl=10 points=5
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    parser = ArgumentParser(usage='[options] tube op [name=value...] | --tubes | --stats')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='Server port')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Server address')
+    parser.add_argument('--tubes', action='store_true', help='List the tubes the server knows')
+    parser.add_argument('--stats', action='store_true', help='Show the server statistics')
+    parser.add_argument('query', nargs='*')
+    args = parser.parse_args()
+    client = tube_client(args.host, args.port)
+    try :
+        if args.tubes :
+            for r in client.tubes() :
+                print r['title']
+        elif args.stats :
+            print json.dumps(client.stats(), indent=1, sort_keys=True)
+        elif len(args.query) >= 2 :
+            params = dict([ (p.split('=', 1)[0], json.loads(p.split('=', 1)[1])) for p in args.query[2:] ])
+            print json.dumps(client.query(args.query[0], args.query[1], **params), indent=1, sort_keys=True)
+        else :
+            parser.print_usage()
+            sys.exit(1)
+    except (query_error, IOError) as exc :
+        print str(exc)
+        sys.exit(1)
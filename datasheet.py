@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import time
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from graphing import single_axis_graph, multi_axis_graph, sample_curves
+from utracer_data import utracer_data
+from tube_map import tube_map
+from catalog import tube_catalog
+from batch import tube_files, worker_pool
+from range import range
+
+# Headless rendering of the standard charts for each tube, using the Agg
+# backend so that no display is needed. As a PDF, a tube's charts are the
+# pages of one document; PNG and SVG have no pages, so there is one file
+# per chart.
+
+CHARTS = ('plate', 'grid', 'derivatives')
+FORMATS = ('pdf', 'png', 'svg')
+PAGE_SIZE = (11, 8.5)           # inches
+DPI = 100
+SAMPLE_SIZE = (PAGE_SIZE[0] * DPI, PAGE_SIZE[1] * DPI)      # pixels to sample curves for
+
+def plate_chart(tm, figure) :
+    vg_values = tm.vg_values()
+    x, y = sample_curves(tm.plate_curves(vg_values), range(0, tm.va_max()), range(0, tm.ia_max()), size=SAMPLE_SIZE)
+    return single_axis_graph.make(None, figure, x_values=x, y_values=y, sampled=True,
+                                  labels=["Vg = %.1f" % (vg,) for vg in vg_values],
+                                  x_label="Va", y_label="Ia (mA)", y_axis=range(0, tm.ia_max()),
+                                  title=tm.title, subtitle=u"Plate Curves")
+
+def grid_chart(tm, figure) :
+    va_values = tm.va_values()
+    x, y = sample_curves(tm.grid_curves(va_values), range(tm.vg_min(), tm.vg_max()), range(0, tm.ia_max()), size=SAMPLE_SIZE)
+    return single_axis_graph.make(None, figure, x_values=x, y_values=y, sampled=True,
+                                  labels=["Va = %.0f" % (va,) for va in va_values],
+                                  x_label="Vg", y_label="Ia (mA)", y_axis=range(0, tm.ia_max()),
+                                  title=tm.title, subtitle=u"Grid Curves")
+
+def derivatives_chart(tm, figure) :
+    labels = ["Gm (mA/V)", u"Rp (KΩ)", u"µ"]
+    eb = tm.va_max() * tube_map.EB_RATIO
+    ia_range, fn = tm.derivative_curves(Eb=eb, Ia=range(tm.ia_min(), tm.ia_max() / 2))
+    x, y = sample_curves(lambda ia: fn(ia)[:len(labels)], list(ia_range), separate=True, size=SAMPLE_SIZE)
+    return multi_axis_graph.make(None, figure, x_values=x, y_values=y, sampled=True,
+                                 labels=labels, x_label="Ia (ma)", title=tm.title,
+                                 subtitle=u"Gm, Rp and µ", note="Eb = %.0f V" % (eb,))
+
+CHART_FUNCTIONS = { 'plate' : plate_chart, 'grid' : grid_chart, 'derivatives' : derivatives_chart }
+
+class datasheet_result(object) :
+    """
+    The outcome of rendering one tube: the files written, and the time
+    taken to load the tube and for each chart (drawing and saving), or
+    error if it failed.
+    """
+
+    def __init__(self, filename, title, files=None, load_time=0, chart_times=None, error=None) :
+        self.filename, self.title, self.files, self.load_time, self.chart_times, self.error = \
+            filename, title, files or [], load_time, chart_times or {}, error
+
+    def elapsed(self) :
+        return self.load_time + sum(self.chart_times.values())
+
+    def __str__(self) :
+        if self.error :
+            return "%-12s error: %s" % (self.title, self.error)
+        return "%-12s load %6.3f s  " % (self.title, self.load_time) + \
+               '  '.join([ "%s %6.3f s" % (c, self.chart_times[c]) for c in CHARTS if c in self.chart_times ]) + \
+               "  total %6.3f s" % (self.elapsed(),)
+
+def file_stem(title) :
+    return re.sub(r'[^\w.-]', '_', title)
+
+def render_tube(filename, directory, formats=('pdf',), charts=CHARTS) :
+    """
+    Load one tube and render its charts into directory, in each of the
+    formats. Returns a datasheet_result; as for batch.load_tube any error
+    is caught and reported in it.
+    """
+    title = tube_catalog.make_title(filename)
+    result = datasheet_result(filename, title)
+    start = time.time()
+    try :
+        tm = tube_map(utracer_data(filename), title)
+        result.load_time = time.time() - start
+        stem = os.path.join(directory, file_stem(title))
+        pdf = PdfPages(stem + '.pdf') if 'pdf' in formats else None
+        try :
+            for c in charts :
+                start = time.time()
+                figure = Figure(figsize=PAGE_SIZE, dpi=DPI)
+                FigureCanvasAgg(figure)
+                CHART_FUNCTIONS[c](tm, figure)
+                if pdf :
+                    pdf.savefig(figure)
+                for f in formats :
+                    if f != 'pdf' :
+                        figure.savefig('%s-%s.%s' % (stem, c, f), format=f)
+                        result.files.append('%s-%s.%s' % (stem, c, f))
+                result.chart_times[c] = time.time() - start
+        finally :
+            if pdf :
+                pdf.close()
+                result.files.insert(0, stem + '.pdf')
+    except Exception as exc :
+        result.error = '%s: %s' % (type(exc).__name__, exc)
+    return result
+
+def _render_tube(args) :
+    return render_tube(*args)
+
+def render_tubes(paths, directory, formats=('pdf',), charts=CHARTS, workers=None) :
+    """
+    Render the charts for all the sweep files in paths (files or
+    directories) using a pool of worker processes, by default one per CPU.
+    Yields a datasheet_result for each file, in the order they finish.
+    """
+    files = tube_files(paths)
+    with worker_pool(workers, len(files)) as pool :
+        for r in pool.imap_unordered(_render_tube, [ (f, directory, formats, charts) for f in files ]) :
+            yield r
+
+def timing_report(results) :
+    """
+    Return the lines of a summary of the time taken for each chart type
+    over all the tubes rendered without error.
+    """
+    good = [ r for r in results if not r.error ]
+    lines = []
+    for name, times in [ ('load', [ r.load_time for r in good ]) ] + \
+                       [ (c, [ r.chart_times[c] for r in good if c in r.chart_times ]) for c in CHARTS ] :
+        if times :
+            lines.append("%-12s %3d tubes  total %7.3f s  mean %6.3f s  max %6.3f s" %
+                         (name, len(times), sum(times), sum(times) / len(times), max(times)))
+    return lines
+
+# Stand-alone use: render the datasheets for the given files and directories,
+# reporting the time taken for each tube and for each chart type.
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    parser = ArgumentParser(usage='[options] file-or-directory...')
+    parser.add_argument('-O', '--output', default='.', help='Directory for the rendered files')
+    parser.add_argument('-f', '--format', action='append', choices=FORMATS,
+                        help='Output format, may be repeated (default pdf)')
+    parser.add_argument('-c', '--chart', action='append', choices=CHARTS,
+                        help='Chart to render, may be repeated (default all)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('-C', '--no-cache', action='store_true', help="Don't use or write parsed data and model caches")
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    if args.no_cache :
+        utracer_data.use_cache = tube_map.use_cache = False
+    if not os.path.isdir(args.output) :
+        os.makedirs(args.output)
+    start = time.time()
+    results = []
+    for r in render_tubes(args.paths, args.output, formats=tuple(args.format or ('pdf',)),
+                          charts=tuple(args.chart or CHARTS), workers=args.workers) :
+        print r
+        results.append(r)
+    print
+    for l in timing_report(results) :
+        print l
+    errors = len([ r for r in results if r.error ])
+    print "%d tubes, %d errors, %.3f s" % (len(results), errors, time.time() - start)
+    sys.exit(1 if errors else 0)
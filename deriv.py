@@ -1,54 +1,101 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import sys
+import glob
+import copy
 import numpy as np
 from argparse import ArgumentParser
 from tube_map import tube_map
 from utracer_data import utracer_data
-from graphing import single_axis_graph, multi_axis_graph
+from catalog import tube_catalog
+from batch import worker_pool
 from range import range
 import os
 
+# graphing (and so matplotlib) is only imported by the functions that draw,
+# since loading it takes longer than the whole of a numeric run (-o, batch).
+
+DERIV_COLUMNS = ['Ia', 'Gm', 'Rp', 'mu', 'Va', 'Vg', 'Failed']
+PLATE_COLUMNS = ['Vg', 'Va', 'Ia']
+GRID_COLUMNS = ['Va', 'Vg', 'Ia']
+MAP_LABELS = { 'gm' : ("Gm (mA/V)", u"Gm Map"), 'rp' : (u"Rp (KΩ)", u"Rp Map"), 'mu' : (u"µ", u"µ Map") }
+SWEEP_COLUMNS = ['Eb', 'Rl', 'Rk', 'Ia', 'Va', 'Vg', 'Gm', 'Rp', 'mu', 'Gain', 'Gain_unbypassed', 'Failed']
+
 def get_args() :
-    parser = ArgumentParser(usage='[options] data-filename')
+    parser = ArgumentParser(usage='[options] data-filename...')
     parser.add_argument('-a', '--Va', type=range, default=None, help='Anode voltage')
     parser.add_argument('-b', '--Eb', type=float, default=0, help='Fixed B+ voltage')
+    parser.add_argument('-C', '--no-cache', action='store_true', help="Don't use or write parsed data and model caches")
     parser.add_argument('-d', '--draw', action='store_true', default=False, help='Draw curves')
+    parser.add_argument('-E', '--Eb-values', type=range, default=None, help='B+ voltages for a sweep (-S)')
+    parser.add_argument('-D', '--difference', action='store_true',
+                        help="Use finite differences rather than the spline's derivatives")
     parser.add_argument('-g', '--Vg', type=range, default=None, help='Grid voltage')
     parser.add_argument('-G', '--grid', action='store_true', help='Draw grid curves')
     parser.add_argument('-i', '--Ia', type=range, default=None, help='Anode current (mA)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Number of worker processes when processing several tubes')
+    parser.add_argument('-M', '--map', choices=sorted(MAP_LABELS), default=None,
+                        help='Draw a map of gm, rp or mu over the whole Va x Vg plane')
+    parser.add_argument('--contours', action='store_true', help='Draw the map (-M) as contours')
+    parser.add_argument('-n', '--points', type=int, default=None, help='Number of points to calculate derivatives for, or of Va and Vg values for a map (-M)')
     parser.add_argument('-o', '--output', action='store_true', help='Send raw numeric data to stdout')
+    parser.add_argument('-k', '--Rk', type=range, default=None, help=u'Cathode resistors for a sweep (-S) (KΩ)')
+    parser.add_argument('-K', '--koren', action='store_true',
+                        help="Use Koren's triode equation fitted to the data rather than a spline")
+    parser.add_argument('-L', '--list', action='store_true',
+                        help='List the tubes in the library (matching the file arguments if given)')
+    parser.add_argument('--library', metavar='DIR', default=None,
+                        help='Tube library directory; the file arguments are then tube names from its catalog')
     parser.add_argument('-l', '--Rl', type=float, default=0, help=u'Load resistor (KΩ)')
+    parser.add_argument('-R', '--Rl-values', type=range, default=None, help=u'Load resistors for a sweep (-S) (KΩ)')
+    parser.add_argument('-S', '--sweep', action='store_true',
+                        help='Write the operating point of a cathode biased stage for every combination '
+                             'of Eb, Rl and Rk (-E, -R, -k)')
     parser.add_argument('-P', '--plate', action='store_true', help='Draw plate curves')
+    parser.add_argument('--purge-cache', metavar='DIR', default=None, help='Remove all parsed data and model caches in DIR')
     parser.add_argument('-s', '--smooth', action='store_true', help='Smooth raw calculations')
     parser.add_argument('-t', '--title', type=unicode, default='', help='Figure title')
     parser.add_argument('-v', '--verbose', action='store_true', help='Show calculations')
     parser.add_argument('-x', '--extra', action='store_true', help='Plot Vg and Va')
-    parser.add_argument('file', nargs='?', default=None)
+    parser.add_argument('files', nargs='*', metavar='file',
+                        help='Data files, directories or glob patterns. With more than one, the chosen '
+                             'analysis is run for all the tubes and written to stdout as a single table')
     args = parser.parse_args()
+    args.file = args.files[0] if args.files else None
     try :
         if args.Rl and not args.Eb :
             raise Exception("Must give a B+ voltage if a load resistance is specified")
         if not args.grid and not args.plate and False :
             raise Exception("Can only specify one of Eb, Va, Vg")
-        if args.file is None :
+        if args.file is None and not (args.purge_cache or args.list) :
             raise Exception("Must give a data file name")
+        if (args.draw or args.map) and is_batch(args) :
+            raise Exception("Can only draw curves for one tube")
     except Exception, exc :
         print str(exc)
         return None
-    if not (args.draw or args.output or args.plate or args.grid) :
+    if args.file is None or args.list :
+        return args
+    if not (args.draw or args.output or args.plate or args.grid or args.sweep or args.map or is_batch(args)) :
         args.draw = True
     if not args.title :
         args.title = os.path.basename(args.file).split('.')[0].upper()
     return args
 
+def is_batch(args) :
+    """
+    Return True if the file arguments can name more than one tube.
+    """
+    return len(args.files) > 1 or any([ glob.has_magic(f) or os.path.isdir(f) for f in args.files ])
+
 def make_range(def_value, value, intervals=6) :
     v = value or def_value
     interval = v / float(intervals)
     interval = round(interval, round_up=False)
     return [ interval * n for n in xrange(int(v/interval)+1) ]
 
-def do_derivs(tm, args) :
+def get_derivs(tm, args) :
     if args.Eb:
         note = u"Eb = %.0f V Rl=%.1f KΩ" % (args.Eb, args.Rl)
     elif args.Vg:
@@ -57,74 +104,247 @@ def do_derivs(tm, args) :
     else:
         args.Va = args.Va.must_be_unique()
         note = "Va = %.0f V" % (args.Va,)
-    derivs = tm.get_derivatives(Eb=args.Eb, Va=args.Va, Vg=args.Vg, Rl=args.Rl, Ia=args.Ia, verbose=args.verbose)
+    derivs = tm.get_derivatives(Eb=args.Eb, Va=args.Va, Vg=args.Vg, Rl=args.Rl, Ia=args.Ia,
+                                points=args.points, method='difference' if args.difference else 'analytic',
+                                verbose=args.verbose)
+    return derivs, note
+
+def do_derivs(tm, args) :
+    derivs, note = get_derivs(tm, args)
 
     if args.output:
-        sys.stdout.write(','.join(['Ia', 'Gm', 'Rp', 'mu', 'Va', 'Vg']) + '\n')
+        sys.stdout.write(','.join(DERIV_COLUMNS) + '\n')
         for r in zip(*derivs):
-            sys.stdout.write(','.join(["%.3f" % (n,) for n in r]) + '\n')
+            sys.stdout.write(','.join(format_row(r)) + '\n')
 
     if args.draw:
+        from graphing import multi_axis_graph, sample_curves
         labels = ["Gm (mA/V)", u"Rp (KΩ)", u"µ"]
         if args.extra:
             labels += ["Va", "Vg"]
-        ia_range = np.linspace(0, args.Ia(), 20)
-        graph = multi_axis_graph(x_values=derivs[0], y_values=derivs[1:len(labels) + 1], labels=labels, x_label="Ia (ma)", title=args.title,
-                                subtitle=u"Gm, Rp and µ", note=note)
+        if args.points :
+            curves = { 'x_values' : derivs[0], 'y_values' : derivs[1:len(labels) + 1] }
+        else :
+            # sample the curves as finely as the graph needs
+            ia_range, fn = tm.derivative_curves(Eb=args.Eb, Va=args.Va, Vg=args.Vg, Rl=args.Rl, Ia=args.Ia,
+                                                method='difference' if args.difference else 'analytic')
+            x, y = sample_curves(lambda ia: fn(ia)[:len(labels)], list(ia_range), separate=True)
+            curves = { 'x_values' : x, 'y_values' : y, 'sampled' : True }
+        graph = multi_axis_graph(labels=labels, x_label="Ia (ma)", title=args.title,
+                                 subtitle=u"Gm, Rp and µ", note=note, **curves)
         if args.verbose:
             for d in derivs:
                 print d
         graph.show()
 
 def do_plate_curves(tm, args) :
-    curves = []
-    labels = []
-    for vg in args.Vg :
-        curves.append([tm(va, vg) for va in args.Va])
-        labels.append("Vg = %.1f" % (vg,))
+    from graphing import single_axis_graph, sample_curves
+    labels = ["Vg = %.1f" % (vg,) for vg in args.Vg]
     if args.verbose :
-        for c, l in zip(curves, labels) :
+        for c, l in zip(tm.surface(list(args.Va), list(args.Vg)).T, labels) :
             print "%10s %s" % (l, '  '.join([ "%.1f" % cc for cc in c]))
-    graph = single_axis_graph(x_values=args.Va, y_values=curves, labels=labels, x_label="Va", y_label="Ia (mA)",
+    x, y = sample_curves(tm.plate_curves(list(args.Vg)), args.Va)
+    graph = single_axis_graph(x_values=x, y_values=y, sampled=True, labels=labels, x_label="Va", y_label="Ia (mA)",
                               title=args.title, subtitle=u"Plate Curves")
     graph.show()
 
 def do_grid_curves(tm, args) :
-    curves = []
-    labels = []
-    for va in args.Va :
-        curves.append([tm(va, vg) for vg in args.Vg])
-        labels.append("Va = %.0f" % (va,))
+    from graphing import single_axis_graph, sample_curves
+    labels = ["Va = %.0f" % (va,) for va in args.Va]
     if args.verbose :
-        for c, l in zip(curves, labels) :
+        for c, l in zip(tm.surface(list(args.Va), list(args.Vg)), labels) :
             print "%10s %s" % (l, '  '.join([ "%.1f" % cc for cc in c]))
-    graph = single_axis_graph(x_values=args.Vg, y_values=curves, labels=labels, x_label="Vg", y_label="Ia (mA)",
+    x, y = sample_curves(tm.grid_curves(list(args.Va)), args.Vg)
+    graph = single_axis_graph(x_values=x, y_values=y, sampled=True, labels=labels, x_label="Vg", y_label="Ia (mA)",
                              title=args.title, subtitle=u": Grid Curves")
     graph.show()
 
+def do_map(tm, args) :
+    from graphing import map_graph
+    label, subtitle = MAP_LABELS[args.map]
+    dmap = tm.derivative_map(points=args.points, method='difference' if args.difference else 'analytic')
+    graph = map_graph(x_values=dmap.va, y_values=dmap.vg, z_values=getattr(dmap, args.map), mask=dmap.mask,
+                      contours=args.contours, x_label="Va", y_label="Vg", z_label=label,
+                      title=args.title, subtitle=subtitle)
+    graph.show()
+
+def model_class(args) :
+    if args.koren :
+        from koren_map import koren_map         # it needs scipy.optimize, which is slow to load
+        return koren_map
+    return tube_map
+
+def sweep_rows(tm, args) :
+    """
+    Solve the operating points for every combination of the Eb, Rl and Rk
+    values, all together (see tube_map.self_bias_point). Returns the rows
+    of the table; Failed is 1 for the points that have no real solution
+    or didn't converge.
+    """
+    eb, rl, rk = [ a.ravel() for a in np.meshgrid(list(args.Eb_values), list(args.Rl_values), list(args.Rk),
+                                                  indexing='ij') ]
+    ia, va, vg, gm, rp, mu, gain, failed = tm.self_bias_point(eb, rl, rk)
+    unbypassed = mu * rl / (rp + rl + (mu + 1) * rk)
+    if failed.any() :
+        print >>sys.stderr, "%s: %d operating points failed (Ia beyond the sweep, or no convergence)" % \
+              (tm.title, failed.sum())
+    return zip(eb, rl, rk, ia, va, vg, gm, rp, mu, gain, unbypassed, failed)
+
+def format_row(r) :
+    return ["%d" % (n,) if isinstance(n, (bool, np.bool_)) else "%.3f" % (n,) for n in r]
+
+def do_sweep(tm, args) :
+    sys.stdout.write(','.join(SWEEP_COLUMNS) + '\n')
+    for r in sweep_rows(tm, args) :
+        sys.stdout.write(','.join(format_row(r)) + '\n')
+
+def set_tube_defaults(tm, args) :
+    """
+    Fill in the arguments whose defaults come from the tube data.
+    """
+    if args.Ia is None :
+        args.Ia = range(tm.ia_min(), tm.ia_max())
+    if args.sweep :
+        eb_max = tm.va_max() * tube_map.EB_RATIO
+        if args.Eb_values is None :
+            args.Eb_values = range(round(eb_max / 2), round(eb_max))
+        if args.Rl_values is None :
+            r = eb_max / tm.ia_max()
+            args.Rl_values = range(round(r * 2, 1), round(r * 20, 1))
+        if args.Rk is None :
+            r = -tm.vg_min() / tm.ia_max()
+            args.Rk = range(round(r, 2), round(r * 10, 2))
+    if args.plate or args.grid :
+        if args.Vg is None:
+            args.Vg = tm.vg_values()
+        if args.Va is None:
+            args.Va = tm.va_values() if args.plate else range(round(tm.va_values()[-1], 2))
+
+def find_files(args) :
+    """
+    Expand the file arguments into a list of data files: through the catalog
+    if a library is given, otherwise as glob patterns and directories.
+    """
+    files = []
+    if args.library :
+        catalog = tube_catalog(args.library)
+        for name in args.files :
+            found = catalog.find(name)
+            exact = [ r for r in found if r['title']==name.upper() ]
+            if not found :
+                print >>sys.stderr, "no tube matching '%s' in %s" % (name, catalog.directory)
+            files += [ os.path.join(args.library, r['filename']) for r in (exact or found) ]
+    else :
+        for f in args.files :
+            if glob.has_magic(f) :
+                files += sorted([ g for g in glob.glob(f) if g.endswith(tube_catalog.EXTENSIONS) ])
+            elif os.path.isdir(f) :
+                files += sorted([ os.path.join(f, g) for g in os.listdir(f) if g.endswith(tube_catalog.EXTENSIONS) ])
+            else :
+                files.append(f)
+    return files
+
+def batch_rows(filename, args) :
+    """
+    Run the chosen analysis for one file in batch mode. Returns
+    (filename, title, rows, error).
+    """
+    args = copy.deepcopy(args)
+    title = tube_catalog.make_title(filename)
+    try :
+        tm = model_class(args)(utracer_data(filename), title)
+        set_tube_defaults(tm, args)
+        if args.sweep :
+            rows = sweep_rows(tm, args)
+        elif args.plate or args.grid :
+            curves = tm.surface(list(args.Va), list(args.Vg))
+            rows = [ (va, vg, ia) for va, c in zip(args.Va, curves) for vg, ia in zip(args.Vg, c) ]
+            if args.plate :
+                rows = sorted([ (vg, va, ia) for va, vg, ia in rows ])
+        else :
+            rows = zip(*get_derivs(tm, args)[0])
+        return (filename, title, rows, None)
+    except Exception as exc :
+        return (filename, title, None, '%s: %s' % (type(exc).__name__, exc))
+
+def _batch_rows(params) :
+    return batch_rows(*params)
+
+def do_batch(files, args) :
+    """
+    Run the analysis for all the files in a pool of worker processes, and write
+    the results to stdout as a single table, in the order the files were given,
+    with the tube title in the first column. Returns the number of errors.
+    """
+    args.verbose = False
+    columns = SWEEP_COLUMNS if args.sweep else PLATE_COLUMNS if args.plate else GRID_COLUMNS if args.grid \
+              else DERIV_COLUMNS
+    with worker_pool(args.workers, len(files)) as pool :
+        results = pool.map(_batch_rows, [ (f, args) for f in files ])
+    errors = 0
+    sys.stdout.write(','.join(['Tube'] + columns) + '\n')
+    for filename, title, rows, error in results :
+        if error :
+            print >>sys.stderr, "%s: %s" % (filename, error)
+            errors += 1
+            continue
+        for r in rows :
+            sys.stdout.write(','.join([title] + format_row(r)) + '\n')
+    return errors
+
+def main() :
+    args = get_args()
+    if args is None :
+        sys.exit(1)
+
+    if args.no_cache :
+        utracer_data.use_cache = tube_map.use_cache = False
+    if args.purge_cache :
+        from koren_map import koren_map
+        print "%d cache files removed" % (utracer_data.purge_cache(args.purge_cache)
+                                          + tube_map.purge_cache(args.purge_cache)
+                                          + koren_map.purge_cache(args.purge_cache),)
+        if args.file is None :
+            sys.exit(0)
 
-args = get_args()
-if args is None :
-    sys.exit(1)
+    if args.list :
+        catalog = tube_catalog(args.library or os.path.dirname(args.file or '') or '.')
+        for pattern in [ os.path.basename(f) for f in args.files ] or [ '' ] :
+            for r in catalog.find(pattern) :
+                print tube_catalog.describe(r)
+            for r in catalog.errors(pattern) :
+                print "%-12s %-18s error: %s" % (r['title'], r['filename'], r['error'])
+        sys.exit(0)
 
-utd = utracer_data(args.file)
-tm = tube_map(utd)
+    files = find_files(args)
+    if not files :
+        sys.exit(1)
+    if len(files) > 1 and args.draw :
+        print "'%s' matches more than one tube: %s" % \
+              (args.file, ', '.join([ tube_catalog.make_title(f) for f in files ]))
+        sys.exit(1)
+    if is_batch(args) or len(files) > 1 :
+        sys.exit(1 if do_batch(files, args) else 0)
 
-if args.Ia is None :
-    args.Ia = range(tm.ia_min(), tm.ia_max())
+    if args.library :
+        tm = tube_catalog(args.library).open(files[0], model_class(args))
+        if args.title == args.file.upper() :
+            args.title = tm.title
+    else :
+        utd = utracer_data(args.file)
+        tm = model_class(args)(utd, args.title)
 
-if args.output or args.draw :
-    do_derivs(tm, args)
-elif args.plate :
-    if args.Vg is None:
-        args.Vg = tm.vg_values()
-    if args.Va is None:
-        args.Va = tm.va_values()
-    do_plate_curves(tm, args)
-elif args.grid :
-    if args.Vg is None:
-        args.Vg = tm.vg_values()
-    if args.Va is None:
-        args.Va = range(round(tm.va_values()[-1], 2))
-    do_grid_curves(tm, args)
+    set_tube_defaults(tm, args)
+    if args.sweep :
+        do_sweep(tm, args)
+    elif args.map :
+        do_map(tm, args)
+    elif args.output or args.draw :
+        do_derivs(tm, args)
+    elif args.plate :
+        do_plate_curves(tm, args)
+    elif args.grid :
+        do_grid_curves(tm, args)
 
+if __name__=='__main__' :
+    main()
@@ -29,3 +29,6 @@ GLOBAL_LEGCANVAS_ORIGIN_Y = 0.4
 GLOBAL_LEGCANVAS_JOINT_BLOB = 3
 GLOBAL_LEGCANVAS_FOOT_BLOB = 4
 GLOBAL_LEGCANVAS_SCALE = 2
+TUBE_LIST_HEIGHT = 8
+DERIV_MAP = True
+PLOT_POLL_MS = 50
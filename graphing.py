@@ -3,6 +3,7 @@ import mpl_toolkits.axisartist as AA
 import matplotlib.pyplot as plt
 from utility import *
 import scipy
+import scipy.interpolate
 import numpy as np
 from range import range
 import sys
@@ -11,11 +12,70 @@ color_list = [ 'red', 'lime', 'mediumblue', 'orange', 'purple', 'turquoise',
                'green', 'yellow', 'brown', 'deepskyblue', 'hotpink', 'peru', 'tomato',
                'olive']
 
+PIXEL_TOLERANCE = 0.25          # largest error allowed when sampling a model, in pixels
+FIRST_SAMPLES = 17              # evenly spaced points to start the adaptive sampling with
+MAX_SAMPLES = 4000              # give up refining after this many points
+MIN_INTERVAL = 0.25             # don't split intervals narrower than this, in pixels
+SAMPLE_SIZE = (640, 480)        # axes size in pixels that sample_curves works to by default
+MAP_COLORMAP = 'viridis'        # colour map for map_graph
+MAP_PERCENTILE = 98             # default top of a map's colour scale, as a percentile of its values (and bottom, from 100)
+MAP_LEVELS = 12                 # number of filled contour levels in a map_graph
+
+def adaptive_sample(fn, x_min, x_max, width, height, y_span=None, separate=False, tolerance=None) :
+    """
+    Sample fn, which takes an array of x values and returns one row of y
+    values per curve, between x_min and x_max, for axes of the given size
+    in pixels. Starting from a few even points, each interval is split
+    while the curves' midpoints are more than tolerance pixels away from
+    the straight line between its ends, so the points are dense where the
+    curves bend and sparse where they're straight. y_span is the range
+    of the y axis; if it isn't given it is estimated from the first
+    samples, for each curve separately if separate is set (for curves
+    with their own axes). All the midpoints of a pass are evaluated in
+    one call. Returns the x values and the array of y values.
+    """
+    tolerance = tolerance or PIXEL_TOLERANCE
+    x = np.linspace(x_min, x_max, FIRST_SAMPLES)
+    y = np.atleast_2d(fn(x))
+    if y_span is None :
+        y_span = np.ptp(y, axis=1)[:, np.newaxis] if separate else np.ptp(y)
+    y_scale = height / np.where(np.asarray(y_span) > 0, y_span, 1.0)
+    x_scale = width / float(x_max - x_min) if x_max > x_min else 0
+    active = np.ones(len(x) - 1, dtype=bool)
+    while active.any() and len(x) < MAX_SAMPLES :
+        left = np.flatnonzero(active)
+        mid_x = (x[left] + x[left + 1]) / 2
+        mid_y = np.atleast_2d(fn(mid_x))
+        error = np.abs(mid_y - (y[:, left] + y[:, left + 1]) / 2) * y_scale
+        split = (error > tolerance).any(axis=0) & ((x[left + 1] - x[left]) * x_scale > 2 * MIN_INTERVAL)
+        x = np.insert(x, left + 1, mid_x)
+        y = np.insert(y, left + 1, mid_y, axis=1)
+        active = np.zeros(len(x) - 1, dtype=bool)
+        first_half = left + np.arange(len(left))
+        active[first_half] = active[first_half + 1] = split
+    return x, y
+
+def sample_curves(fn, x_values, y_axis=None, separate=False, size=None) :
+    """
+    Sample the curves given by fn (see adaptive_sample) across the range
+    of x_values, for axes of size (width, height) pixels, by default
+    SAMPLE_SIZE, and the given y_axis range if any. This makes no
+    matplotlib calls, so it can run in a background thread (see
+    plot_worker). The result is the x_values and y_values for a graph,
+    with sampled set.
+    """
+    width, height = size or SAMPLE_SIZE
+    y_span = max(y_axis) - min(y_axis) if y_axis and not separate else None
+    return adaptive_sample(fn, min(x_values), max(x_values), width, height, y_span, separate)
+
 class graph_base(object) :
 
+    RESAMPLE_FACTOR = 10        # extra density when interpolating raw data
+
     arg_table = { \
     'x_values': [],
     'y_values' : [[]],
+    'sampled' : False,
     'y_axis' : None,
     'x_label' : '',
     'y_label' : '',
@@ -24,21 +84,123 @@ class graph_base(object) :
     'subtitle' : '',
     'titlepos' : None,
     'note' : None,
+    'figure' : None,
     }
 
     def __init__(self, **kwargs):
+        """
+        The curves are given as y_values, a row for each curve, at the
+        x_values. They are either raw data, which is smoothed, or if
+        sampled is set, have been sampled from a model as finely as the
+        axes need (see sample_curves) and are plotted as they are.
+
+        If a figure is given (e.g. one belonging to a GUI canvas) the graph
+        is drawn on it, after clearing it. Otherwise a new pyplot figure is
+        made.
+        """
         construct(self, graph_base.arg_table, kwargs)
-        self.figure, self.subplot = plt.subplots()
+        if self.figure :
+            self.figure.clf()
+            self._prune_transforms()
+            self.subplot = self.figure.add_subplot(111)
+        else :
+            self.figure, self.subplot = plt.subplots()
+        self.lines = []
         self.legends = []
+        self.note_text = None
+        self.layout_changed = True
         #self.figure.set_size_inches(9,7, forward=True)
 
+    def _prune_transforms(self):
+        """
+        matplotlib 2 leaves a dead weak reference behind in the figure's
+        transforms for every artist that has used them, so a figure that is
+        cleared and reused keeps growing. Remove them.
+        """
+        for t in (self.figure.dpi_scale_trans, self.figure.transFigure) :
+            t._parents = dict([ (k, v) for k, v in t._parents.items() if v() is not None ])
+
+    @classmethod
+    def make(cls, previous=None, figure=None, **kwargs):
+        """
+        Return a finished graph for kwargs. If previous is a graph of the
+        same class with the same number of curves, it is updated in place
+        (see update()) and returned, otherwise a new graph is drawn on
+        previous's figure, or on figure if there is no previous graph.
+        """
+        if type(previous) is cls and previous.can_update(**kwargs) :
+            previous.update(**kwargs)
+            return previous
+        graph = cls(figure=previous.figure if previous else figure, **kwargs)
+        graph.finish()
+        return graph
+
+    def can_update(self, **kwargs):
+        return len(kwargs.get('y_values', [])) == len(self.lines)
+
+    def update(self, **kwargs):
+        """
+        Replace the data, limits, labels, title, note and legend, reusing
+        the existing axes and lines. Afterwards layout_changed is False if
+        only the line data has changed, so that just the lines need to be
+        redrawn.
+        """
+        layout = self.layout()
+        construct(self, graph_base.arg_table, dict(kwargs, figure=self.figure))
+        self.legends = []
+        self.draw()
+        self.finish()
+        self.layout_changed = self.layout() != layout
+
+    def layout(self):
+        """
+        Everything about the graph apart from the line data.
+        """
+        return (self.title, self.subtitle, self.note, self.x_label, self.y_label, tuple(self.labels)) + \
+               tuple([ (sp.get_xlim(), sp.get_ylim()) for sp in self.figure.axes ])
+
+    def draw(self):
+        pass
+
+    def animated_artists(self):
+        """
+        The artists that graph_canvas redraws on their own when only they
+        have changed.
+        """
+        return self.lines
+
     def add_plot(self, subplot, x, y, label=None, color='black'):
-        new_x = np.linspace(min(x), max(x), num=len(x) * 10, endpoint=True)
-        interp = scipy.interpolate.interp1d(x, y, kind='cubic')
-        p, = subplot.plot(new_x, interp(new_x), label=label, color=color)
+        """
+        Plot the curve, or if there is already a line for it (when the graph
+        is being updated) replace the line's data. Sampled curves are
+        plotted as they are; raw data is smoothed with a cubic
+        interpolation.
+        """
+        if not self.sampled :
+            new_x = np.linspace(min(x), max(x), num=len(x) * graph_base.RESAMPLE_FACTOR, endpoint=True)
+            x, y = new_x, scipy.interpolate.interp1d(x, y, kind='cubic')(new_x)
+        n = self._next_line
+        self._next_line += 1
+        if n < len(self.lines) :
+            p = self.lines[n]
+            p.set_data(x, y)
+            p.set_label(label)
+            p.set_color(color)
+        else :
+            p, = subplot.plot(x, y, label=label, color=color)
+            self.lines.append(p)
         return p
 
     def add_legend(self) :
+        if self.legends :
+            labels = [ l[1] for l in self.legends ]
+        else :
+            labels = [ p.get_label() for p in self.lines if p.get_label() and p.get_label()[0]!='_' ]
+        if self.subplot.get_legend() and len(self.subplot.get_legend().get_texts())==len(labels) :
+            # updating: just change the text, since each new legend leaves a callback behind on the axes
+            for t, l in zip(self.subplot.get_legend().get_texts(), labels) :
+                t.set_text(l)
+            return
         if self.legends:
             z = zip(*self.legends)
             self.legend = self.subplot.legend(handles=z[0], labels=z[1], loc="best")
@@ -61,8 +223,11 @@ class graph_base(object) :
             self.subplot.title.set_weight("bold")
 
     def add_note(self):
+        if self.note_text :
+            self.note_text.remove()
+            self.note_text = None
         if self.note :
-            self.subplot.text(0.5, 0.9, self.note, transform=self.subplot.transAxes, fontsize=12, fontweight="bold")
+            self.note_text = self.subplot.text(0.5, 0.9, self.note, transform=self.subplot.transAxes, fontsize=12, fontweight="bold")
 
     def _do_x_axis(self) :
         if isinstance(self.x_values, range) :
@@ -105,6 +270,10 @@ class single_axis_graph(graph_base) :
 
     def __init__(self, **kwargs) :
         graph_base.__init__(self, **kwargs)
+        self.draw()
+
+    def draw(self) :
+        self._next_line = 0
         self._do_x_axis()
         self._do_y_axis()
         for lab, y, c in zip(self.labels, self.y_values, self.colors()):
@@ -124,8 +293,15 @@ class multi_axis_graph(graph_base) :
             sp.set_frame_on(True)
             sp.patch.set_visible(False)
             offset += 0.16
+        self.draw()
+
+    def can_update(self, **kwargs) :
+        return len(kwargs.get('labels', [])) == len(self.subplots) \
+               and super(multi_axis_graph, self).can_update(**kwargs)
+
+    def draw(self) :
+        self._next_line = 0
         self._do_x_axis()
-        legends = []
         for sp, l, y, c in zip(self.subplots, self.labels, self.y_values, self.colors()) :
             p = self.add_plot(sp, self.x_values, y, l, color=c)
             ymin = round(min(min(y), 0), 1, round_up=False)
@@ -135,3 +311,135 @@ class multi_axis_graph(graph_base) :
             sp.tick_params('y', colors=c)
             self.add_legend_item(l, c)
 
+
+class load_line_graph(single_axis_graph) :
+    """
+    Plate curves with a load line and its operating point drawn over them,
+    and a note of the operating point. Only the overlay is animated, so
+    moving the load line just redraws that (see graph_canvas).
+    """
+
+    def __init__(self, **kwargs) :
+        single_axis_graph.__init__(self, **kwargs)
+        self.load_line, = self.subplot.plot([], [], color='black', linewidth=1.5)
+        self.q_point, = self.subplot.plot([], [], 'o', color='black')
+        self.q_text = self.subplot.text(0.97, 0.03, '', transform=self.subplot.transAxes, fontsize=10,
+                                        horizontalalignment='right', verticalalignment='bottom',
+                                        bbox={ 'facecolor' : 'white', 'alpha' : 0.7 })
+
+    def animated_artists(self) :
+        return [ self.load_line, self.q_point, self.q_text ]
+
+    def update(self, **kwargs) :
+        single_axis_graph.update(self, **kwargs)
+        self.layout_changed = True          # the plate curves aren't animated
+
+    def set_operating_point(self, va, ia, q_va, q_ia, text) :
+        """
+        Move the load line (from the arrays va and ia) and the operating
+        point, and change the note.
+        """
+        self.load_line.set_data(va, ia)
+        self.q_point.set_data([q_va], [q_ia])
+        self.q_text.set_text(text)
+
+class map_graph(graph_base) :
+    """
+    A quantity over the Va x Vg plane, such as one of the maps made by
+    tube_map.derivative_map(), drawn as a heatmap with a colour bar, or
+    as filled contours if contours is set. x_values and y_values are the
+    evenly spaced Va and Vg values, and z_values the quantity, with a row
+    for each Va value. Points where mask is set (e.g. beyond cutoff) are
+    left blank. z_axis gives the range of the colour scale; by default it
+    leaves out the top and bottom (100 - MAP_PERCENTILE) percent of the
+    values, so that a few extreme ones (rp near cutoff) don't swamp the
+    rest.
+    """
+
+    arg_table = { \
+    'z_values' : None,
+    'z_axis' : None,
+    'z_label' : '',
+    'mask' : None,
+    'contours' : False,
+    }
+
+    def __init__(self, **kwargs) :
+        construct(self, map_graph.arg_table, kwargs)
+        graph_base.__init__(self, **kwargs)
+        self.draw()
+
+    def can_update(self, **kwargs) :
+        return False                    # the colour bar has to be remade anyway
+
+    def animated_artists(self) :
+        return []
+
+    def draw(self) :
+        va, vg = np.asarray(self.x_values, dtype=float), np.asarray(self.y_values, dtype=float)
+        z = np.ma.masked_invalid(np.asarray(self.z_values, dtype=float))
+        if self.mask is not None :
+            z = np.ma.masked_where(self.mask, z)
+        shown = z.compressed()
+        if self.z_axis :
+            low, high = min(self.z_axis), max(self.z_axis)
+        elif len(shown) :
+            low, high = np.percentile(shown, (100 - MAP_PERCENTILE, MAP_PERCENTILE))
+        else :
+            low, high = 0, 1
+        if self.contours :
+            levels = np.linspace(low, high, MAP_LEVELS + 1)
+            image = self.subplot.contourf(va, vg, z.T, levels, cmap=MAP_COLORMAP, extend='both')
+            self.subplot.contour(va, vg, z.T, levels, colors='black', linewidths=0.5)
+        else :
+            image = self.subplot.imshow(z.T, origin='lower', aspect='auto', interpolation='nearest',
+                                        extent=(va[0], va[-1], vg[0], vg[-1]), cmap=MAP_COLORMAP,
+                                        vmin=low, vmax=high)
+        self.colorbar = self.figure.colorbar(image, ax=self.subplot)
+        self.colorbar.set_label(self.z_label)
+        self.subplot.set_xlim(va[0], va[-1])
+        self.subplot.set_ylim(vg[0], vg[-1])
+        self.subplot.set_xlabel(self.x_label)
+        self.subplot.set_ylabel(self.y_label)
+
+    def add_legend(self) :
+        pass
+
+class graph_canvas(object) :
+    """
+    Shows a succession of graphs on one canvas (and its figure), e.g. a
+    FigureCanvasTkAgg. The graph's animated_artists() (normally its
+    lines) are animated, so that when a graph has been updated in place
+    with only those changed (see graph_base.update), the rest of the
+    figure can be restored from the saved background and just they are
+    redrawn and blitted. Otherwise the whole figure is drawn and the
+    background saved again.
+    """
+
+    def __init__(self, canvas) :
+        self.canvas = canvas
+        self.figure = canvas.figure
+        self.graph = None
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def show(self, graph) :
+        for a in graph.animated_artists() :
+            a.set_animated(True)
+        if graph is self.graph and not graph.layout_changed and self.background is not None :
+            self.canvas.restore_region(self.background)
+            self._draw_animated()
+            self.canvas.blit(self.figure.bbox)
+        else :
+            self.graph = graph
+            self.canvas.draw()
+            graph.layout_changed = False
+
+    def _on_draw(self, event) :
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_animated()
+
+    def _draw_animated(self) :
+        if self.graph :
+            for a in self.graph.animated_artists() :
+                a.axes.draw_artist(a)
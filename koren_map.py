@@ -0,0 +1,189 @@
+import os
+import numpy as np
+import scipy.special
+from copy import copy
+from tube_map import tube_map
+from utility import *
+
+class koren_map(tube_map):
+    """
+    A tube_map whose Ia comes from Koren's triode equation
+
+        E1 = Va / kp * log(1 + exp(kp * (1 / mu + Vg / sqrt(kvb + Va ** 2))))
+        Ia = 1000 * E1 ** ex / kg1          (mA)
+
+    with the five parameters fitted to the sweep by least squares, instead
+    of a spline through it. Everything is in closed form on arrays: Ia,
+    gm and rp, and Vg from Ia; Va from Ia is found by bisection on the
+    closed form. The rest of the tube_map interface (ranges, point cache,
+    get_derivatives and so on) works as before. The fitted parameters are
+    saved next to the source file and reused, see tube_map.__init__.
+    """
+    PARAMETERS = ('mu', 'ex', 'kg1', 'kp', 'kvb')
+    START_MU = (5.0, 20.0, 50.0, 100.0)   # the fit is started from each of these and the best kept
+    START = (1.4, 300.0, 300.0)           # starting ex, kp and kvb; kg1 is estimated from the data
+    FIT_VERSION = 1                       # change this if the fit or the saved parameters change
+    MODEL_SUFFIX = '.koren.npz'
+
+    def _fit(self):
+        self._set_source()
+        self._default_ia = self.data[-3][-3]
+        va, vg = np.meshgrid(self.va, self.vg, indexing='ij')
+        self.params = self._fit_params(va.ravel(), vg.ravel(), np.array(self.data).ravel())
+        residuals = self.residuals()
+        self.residual_rms, self.residual_max = np.sqrt(np.mean(residuals ** 2)), np.abs(residuals).max()
+
+    def _fit_params(self, va, vg, ia):
+        """
+        Fit the parameters (as logs, to keep them positive) to the measured
+        points, from each starting mu in turn, and return the best.
+        """
+        import scipy.optimize                   # slow to load, and not needed for saved parameters
+        best = None
+        for mu in koren_map.START_MU :
+            ex, kp, kvb = koren_map.START
+            e1 = koren_map._e1(va, vg, mu, kp, kvb)
+            bright = ia > self.ia_max() * 0.1
+            kg1 = np.median(1000 * e1[bright] ** ex / ia[bright])
+            start = np.log([ mu, ex, kg1, kp, kvb ])
+            try :
+                fit = scipy.optimize.least_squares(lambda p: koren_map._ia(va, vg, *np.exp(p)) - ia, start)
+            except ValueError :
+                continue                        # e.g. the start gives non-finite residuals
+            if best is None or fit.cost < best.cost :
+                best = fit
+        if best is None :
+            raise ValueError("can't fit the Koren equation to %s" % (self.title,))
+        return np.exp(best.x)
+
+    @staticmethod
+    def _e1(va, vg, mu, kp, kvb):
+        va = np.maximum(va, 0)
+        return va / kp * np.logaddexp(0, kp * (1 / mu + vg / np.sqrt(kvb + va * va)))
+
+    @staticmethod
+    def _ia(va, vg, mu, ex, kg1, kp, kvb):
+        return 1000 * koren_map._e1(va, vg, mu, kp, kvb) ** ex / kg1
+
+    def fit_settings(self):
+        return np.array([koren_map.FIT_VERSION])
+
+    def model_filename(self):
+        return self.udata.filename + koren_map.MODEL_SUFFIX
+
+    def save(self, filename):
+        with open(filename, 'wb') as f :
+            np.savez(f, settings=self.fit_settings(),
+                     source_hash=self._source_hash,
+                     title=self.title,
+                     params=self.params,
+                     va=self.va, vg=self.vg,
+                     ia_bounds=[self._ia_min, self._ia_max],
+                     default_ia=self._default_ia,
+                     residuals=[self.residual_rms, self.residual_max])
+
+    def _restore(self, model):
+        self.params = model['params']
+        self._restore_source(model)
+        self.original_va, self.original_vg = copy(self.va), copy(self.vg)
+        self.residual_rms, self.residual_max = model['residuals'].tolist()
+
+    def _model_size(self):
+        return self.params.nbytes
+
+    def parameters(self):
+        return dict(zip(koren_map.PARAMETERS, self.params.tolist()))
+
+    def residuals(self):
+        """
+        Return the measured Ia less the fitted Ia at every point of the
+        sweep, as an array with a row for each Va value. The RMS and
+        largest of these are kept (and saved) as residual_rms and
+        residual_max, which are all there is for a map recreated by load(),
+        since that has no source data.
+        """
+        if self.udata is None :
+            raise ValueError("%s has no source data for the residuals, only residual_rms (%.3f mA) and "
+                             "residual_max (%.3f mA)" % (self.title, self.residual_rms, self.residual_max))
+        va, vg, data = self.udata.get()
+        return np.array(data) - self.ia(np.array(va)[:, np.newaxis], vg)
+
+    def _point(self, Va, Vg):
+        return float(self.ia(Va, Vg))
+
+    def ia(self, Va, Vg):
+        result = koren_map._ia(np.asarray(Va, dtype=float), np.asarray(Vg, dtype=float), *self.params)
+        return np.where(result < tube_map.IA_CLAMP, 0.0, result)
+
+    def _derivatives(self, Va, Vg):
+        """
+        gm, rp and mu from the derivatives of the equation.
+        """
+        mu, ex, kg1, kp, kvb = self.params
+        va, vg = np.maximum(np.asarray(Va, dtype=float), 0), np.asarray(Vg, dtype=float)
+        s = np.sqrt(kvb + va * va)
+        u = kp * (1 / mu + vg / s)
+        e1 = va / kp * np.logaddexp(0, u)
+        sigma = scipy.special.expit(u)
+        dia_de1 = 1000 * ex * np.maximum(e1, 0) ** (ex - 1) / kg1
+        gm = dia_de1 * va * sigma / s
+        invrp = dia_de1 * (np.logaddexp(0, u) / kp - sigma * vg * va * va / s ** 3)
+        rp = np.where(invrp > 0, 1 / np.where(invrp > 0, invrp, 1), 0.0)
+        return (gm, rp, gm * rp)
+
+    def _Va_from_Ia(self, Vg, Ia):
+        return float(self._Va_from_Ia_array(Vg, Ia)[0])
+
+    def _Vg_from_Ia(self, Va, Ia):
+        return float(self._Vg_from_Ia_array(Va, Ia)[0])
+
+    def _Vg_from_Ia_array(self, Va, Ia, rtol=1e-05, atol=1e-08, max_iterations=None):
+        """
+        The inverse of the equation for Vg, clamped to the sweep's range.
+        As for x_from_y_array, failed marks the points where Ia at the
+        result is not the target within rtol and atol, i.e. those that
+        can't be reached within the sweep. There is nothing to iterate, so
+        max_iterations is only accepted to match tube_map.
+        """
+        mu, ex, kg1, kp, kvb = self.params
+        va, ia = np.broadcast_arrays(np.maximum(np.asarray(Va, dtype=float), 0), np.asarray(Ia, dtype=float))
+        ok = (ia > 0) & (va > 0)
+        y = np.where(ok, (np.where(ok, ia, 1) * kg1 / 1000) ** (1 / ex) * kp / np.where(ok, va, 1), 1)
+        u = y + np.log(-np.expm1(-y))           # inverse of log(1 + exp(u))
+        vg = np.clip(np.where(ok, (u / kp - 1 / mu) * np.sqrt(kvb + va * va),
+                              np.where(ia > 0, np.inf, -np.inf)), *self.vg_range())
+        return vg, ~np.isclose(ia, self.ia(va, vg), rtol=rtol, atol=atol)
+
+    def Va_from_Ia_table(self, Vg, Ia, refine=None):
+        return self._Va_from_Ia_array(Vg, Ia)[0]
+
+    def Vg_from_Ia_table(self, Va, Ia, refine=None):
+        return self._Vg_from_Ia_array(Va, Ia)[0]
+
+# Test code - executed if the file is run stand-alone
+#
+# Fits each file in the data directory (or the files given as arguments)
+# and shows the parameters, the residuals, and the time to fit and to
+# reload the saved parameters.
+
+if __name__=="__main__" :
+    import sys
+    import time
+    from utracer_data import utracer_data
+    files = sys.argv[1:] or \
+            sorted(os.path.join('data', f) for f in os.listdir('data') if f.endswith(('.txt', '.utd')))
+    print '%-18s %7s %5s %8s %8s %8s  %8s %8s  %8s %8s' % \
+          (('',) + koren_map.PARAMETERS + ('rms mA', 'max mA', 'fit s', 'load s'))
+    for f in files :
+        try :
+            start = time.time()
+            km = koren_map(utracer_data(f), f, use_cache=False)
+            fit_time = time.time() - start
+            km.save(km.model_filename())
+            start = time.time()
+            koren_map(utracer_data(f), f)
+            print '%-18s %7.2f %5.3f %8.1f %8.1f %8.1f  %8.3f %8.3f  %8.3f %8.4f' % \
+                  ((f,) + tuple(km.params) + (km.residual_rms, km.residual_max,
+                                              fit_time, time.time() - start))
+        except ValueError as exc :
+            print '%-18s %s' % (f, exc)
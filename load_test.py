@@ -0,0 +1,69 @@
+#!/usr/bin/python
+"""
+Load test for server.py: a number of client threads send random queries
+(Ia, derivatives and Vg from Ia at random points within each tube's sweep)
+for a fixed time, each request holding a batch of queries. Reports the
+throughput and the latency distribution per request.
+
+    python load_test.py [-c clients] [-b batch] [-d seconds] [tube...]
+"""
+
+import time
+import threading
+import numpy as np
+from argparse import ArgumentParser
+from client import tube_client, query_error
+from server import DEFAULT_PORT
+
+def make_query(rs, tube) :
+    va = round(rs.uniform(*tube['va_range']), 2)
+    vg = round(rs.uniform(*tube['vg_range']), 2)
+    ia = round(rs.uniform(tube['ia_range'][1] / 100, tube['ia_range'][1]), 3)
+    op = rs.choice(['ia', 'derivatives', 'Vg_from_Ia'])
+    if op == 'Vg_from_Ia' :
+        return { 'tube' : tube['title'], 'op' : op, 'Va' : va, 'Ia' : ia }
+    return { 'tube' : tube['title'], 'op' : op, 'Va' : va, 'Vg' : vg }
+
+def run_client(args, tubes, seed, latencies, errors) :
+    rs = np.random.RandomState(seed)
+    client = tube_client(args.host, args.port)
+    end = time.time() + args.duration
+    while time.time() < end :
+        queries = [ make_query(rs, tubes[rs.randint(len(tubes))]) for i in xrange(args.batch) ]
+        start = time.time()
+        try :
+            results = client.batch(queries)
+            errors.append(sum([ 'error' in r for r in results ]))
+        except (query_error, IOError) :
+            errors.append(args.batch)
+        latencies.append(time.time() - start)
+    client.close()
+
+if __name__=="__main__" :
+    parser = ArgumentParser(usage='[options] [tube...]')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='Server port')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Server address')
+    parser.add_argument('-c', '--clients', type=int, default=4, help='Number of concurrent clients')
+    parser.add_argument('-b', '--batch', type=int, default=1, help='Queries per request')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Test duration (s)')
+    parser.add_argument('tubes', nargs='*', help='Tubes to query (default all)')
+    args = parser.parse_args()
+    tubes = tube_client(args.host, args.port).tubes()
+    if args.tubes :
+        tubes = [ t for t in tubes if t['title'] in [ n.upper() for n in args.tubes ] ]
+    latencies, errors = [], []
+    threads = [ threading.Thread(target=run_client, args=(args, tubes, n, latencies, errors))
+                for n in xrange(args.clients) ]
+    start = time.time()
+    for t in threads :
+        t.start()
+    for t in threads :
+        t.join()
+    elapsed = time.time() - start
+    ms = np.array(latencies) * 1000
+    print "%d clients, %d queries per request, %d tubes, %.1f s" % (args.clients, args.batch, len(tubes), elapsed)
+    print "%d requests (%.0f/s), %d queries (%.0f/s), %d errors" % \
+          (len(ms), len(ms) / elapsed, len(ms) * args.batch, len(ms) * args.batch / elapsed, sum(errors))
+    print "latency ms: median %.2f  95%% %.2f  99%% %.2f  max %.2f" % \
+          (np.median(ms), np.percentile(ms, 95), np.percentile(ms, 99), ms.max())
+    print "server:", tube_client(args.host, args.port).stats()
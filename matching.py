@@ -0,0 +1,285 @@
+#!/usr/bin/python
+import sys
+import time
+import numpy as np
+from utracer_data import utracer_data
+from tube_map import tube_map
+from catalog import tube_catalog
+from batch import tube_files, worker_pool
+
+# Sorting a set of tubes of one type into matched pairs and quads. Every
+# tube is described by the same feature vector: Ia over a shared (Va, Vg)
+# grid, and Ia, gm and rp at shared load line operating points. The
+# distance between two tubes is the weighted RMS of the differences of
+# their features, each kind scaled to be relative (see match_points).
+
+GRID_POINTS = 8                 # Va and Vg values in the shared grid
+BIAS_FRACTIONS = (0.25, 0.5, 0.75)  # operating point grid bias, as a fraction of the lowest Vg
+WEIGHTS = { 'ia' : 1.0, 'q_ia' : 1.0, 'gm' : 1.0, 'rp' : 0.5 }
+CHUNK = 512                     # rows of the distance matrix calculated at once
+NEIGHBOURS = 8                  # nearest neighbours considered for each tube when pairing
+
+class match_points(object) :
+    """
+    The points at which every tube is evaluated: a grid of Va and Vg
+    values covering the ranges common to all the tubes, and load line
+    operating points at Eb, Rl and a few grid biases. kinds gives the
+    kind of each feature, and scale how much it is divided by: the common
+    maximum Ia for currents, and the mean over the tubes (see
+    set_scale) for gm and rp.
+    """
+
+    def __init__(self, va_range, vg_range, ia_max, points=None, weights=None) :
+        points = points or GRID_POINTS
+        self.va = np.linspace(va_range[0], va_range[1], points + 1)[1:]
+        self.vg = np.linspace(vg_range[0], vg_range[1], points)
+        self.eb = va_range[1] * tube_map.EB_RATIO
+        self.rl = 2 * self.eb / ia_max
+        self.q_vg = np.array([ vg_range[0] * f for f in BIAS_FRACTIONS ])
+        self.weights = dict(WEIGHTS, **(weights or {}))
+        self.kinds = np.array(['ia'] * (len(self.va) * len(self.vg)) + ['q_ia', 'gm', 'rp'] * len(self.q_vg))
+        self.scale = np.where(np.char.endswith(self.kinds, 'ia'), ia_max, 1.0)
+
+    @classmethod
+    def common(cls, ranges, **kwargs) :
+        """
+        Make the points for the ranges, a list of (va_range, vg_range,
+        ia_range) for each tube, using the part that all of them cover.
+        """
+        va = (max([ r[0][0] for r in ranges ]), min([ r[0][1] for r in ranges ]))
+        vg = (max([ r[1][0] for r in ranges ]), min([ r[1][1] for r in ranges ]))
+        if va[0] >= va[1] or vg[0] >= vg[1] :
+            raise ValueError("the tubes' Va and Vg ranges don't overlap")
+        return cls(va, vg, min([ r[2][1] for r in ranges ]), **kwargs)
+
+    def features(self, tm) :
+        """
+        Evaluate the features for one tube: the grid in a single spline
+        evaluation, and all the operating points together.
+        """
+        grid = tm.ia(self.va[:, np.newaxis], self.vg).ravel()
+        va, ia, failed = tm.load_line_point(self.eb, self.rl, self.q_vg)
+        gm, rp, mu = tm.derivatives(va, self.q_vg)
+        return np.concatenate([ grid, np.column_stack([ ia, gm, rp ]).ravel() ])
+
+    def set_scale(self, features) :
+        """
+        Scale gm and rp by their mean over all the tubes.
+        """
+        mean = np.abs(features).mean(axis=0)
+        derived = ~np.char.endswith(self.kinds, 'ia')
+        self.scale[derived] = np.where(mean[derived] > 0, mean[derived], 1.0)
+
+    def column_weights(self) :
+        """
+        The factor for each scaled feature that makes the Euclidean distance
+        the weighted RMS difference over the kinds of feature.
+        """
+        total = sum([ self.weights[k] for k in set(self.kinds) ])
+        counts = dict([ (k, (self.kinds == k).sum()) for k in set(self.kinds) ])
+        return np.sqrt(np.array([ self.weights[k] / (counts[k] * total) for k in self.kinds ]))
+
+def overlapping(ranges) :
+    """
+    Return the indices of the ranges (as for match_points.common) to keep
+    so that the rest overlap, leaving out as few tubes as possible. While
+    they don't overlap, one of the tubes that sets a limit is dropped,
+    the one whose removal leaves the most of the Va and Vg ranges.
+    """
+    keep = range(len(ranges))
+    low = np.array([ (r[0][0], r[1][0]) for r in ranges ], dtype=float)
+    high = np.array([ (r[0][1], r[1][1]) for r in ranges ], dtype=float)
+    def score(indices) :
+        width = high[indices].min(axis=0) - low[indices].max(axis=0)
+        return (np.minimum(width, 0).sum(), np.prod(np.maximum(width, 0)))
+    while score(keep)[0] < 0 or score(keep)[1] == 0 :
+        candidates = set([ keep[low[keep, 0].argmax()], keep[high[keep, 0].argmin()],
+                           keep[low[keep, 1].argmax()], keep[high[keep, 1].argmin()] ])
+        keep.remove(max(candidates, key=lambda c: score([ i for i in keep if i != c ])))
+    return keep
+
+def distance_chunks(a, b, chunk=None) :
+    """
+    Yield (start, block) for the matrix of Euclidean distances between the
+    rows of a and the rows of b, a block of chunk rows of a at a time so
+    that memory stays bounded however many rows there are.
+    """
+    chunk = chunk or CHUNK
+    b2 = (b * b).sum(axis=1)
+    for start in xrange(0, len(a), chunk) :
+        rows = a[start:start + chunk]
+        d2 = (rows * rows).sum(axis=1)[:, np.newaxis] + b2 - 2 * np.dot(rows, b.T)
+        yield start, np.sqrt(np.maximum(d2, 0))
+
+def nearest(features, k, chunk=None) :
+    """
+    Return (index, distance), each with a row for every feature vector
+    giving its k nearest neighbours (excluding itself) in order.
+    """
+    k = min(k, len(features) - 1)
+    index = np.empty((len(features), k), dtype=int)
+    distance = np.empty((len(features), k))
+    for start, block in distance_chunks(features, features, chunk) :
+        rows = np.arange(len(block))
+        block[rows, start + rows] = np.inf
+        near = np.argpartition(block, k - 1, axis=1)[:, :k]
+        d = block[rows[:, np.newaxis], near]
+        order = np.argsort(d, axis=1)
+        index[start:start + len(block)] = near[rows[:, np.newaxis], order]
+        distance[start:start + len(block)] = d[rows[:, np.newaxis], order]
+    return index, distance
+
+def greedy_pairs(features, max_distance=None, neighbours=None, chunk=None) :
+    """
+    Pair up the rows of features: the candidates are each row's nearest
+    neighbours, taken closest first whenever both are still free. Rows
+    left over are matched again among themselves, until no more pairs
+    can be made. Returns a list of (i, j, distance), closest first.
+    """
+    neighbours = neighbours or NEIGHBOURS
+    free = np.arange(len(features))
+    pairs = []
+    while len(free) > 1 :
+        index, distance = nearest(features[free], neighbours, chunk)
+        i = np.repeat(np.arange(len(free)), index.shape[1])
+        j, d = index.ravel(), distance.ravel()
+        keep = i < j
+        if max_distance is not None :
+            keep &= d <= max_distance
+        order = np.argsort(d[keep], kind='mergesort')
+        taken = np.zeros(len(free), dtype=bool)
+        found = []
+        for a, b, dd in zip(i[keep][order].tolist(), j[keep][order].tolist(), d[keep][order].tolist()) :
+            if not (taken[a] or taken[b]) :
+                taken[a] = taken[b] = True
+                found.append((free[a], free[b], dd))
+        if not found :
+            break
+        pairs += found
+        free = free[~taken]
+    return sorted(pairs, key=lambda p: p[2])
+
+class tube_matcher(object) :
+    """
+    Matches a set of tubes, given their names and the feature vectors
+    from match_points.features(). pairs() and quads() return the best
+    matched pairs and quads, with the distance for each (for a quad, the
+    largest distance between any two of its tubes).
+    """
+
+    def __init__(self, names, features, points, chunk=None, neighbours=None) :
+        self.names = names
+        self.points = points
+        self.points.set_scale(features)
+        self.features = features / points.scale * points.column_weights()
+        self.chunk, self.neighbours = chunk, neighbours
+
+    def distance(self, i, j) :
+        return float(np.sqrt(((self.features[i] - self.features[j]) ** 2).sum()))
+
+    def pairs(self, max_distance=None) :
+        return greedy_pairs(self.features, max_distance, self.neighbours, self.chunk)
+
+    def quads(self, max_distance=None) :
+        """
+        Match the pairs with each other as if each was a single tube whose
+        features are the mean of the two, keeping quads whose largest
+        distance is within max_distance.
+        """
+        pairs = self.pairs(max_distance)
+        if len(pairs) < 2 :
+            return []
+        members = np.array([ (i, j) for i, j, d in pairs ])
+        centres = (self.features[members[:, 0]] + self.features[members[:, 1]]) / 2
+        result = []
+        for a, b, d in greedy_pairs(centres, max_distance, self.neighbours, self.chunk) :
+            tubes = tuple(members[a]) + tuple(members[b])
+            spread = max([ self.distance(t1, t2) for n, t1 in enumerate(tubes) for t2 in tubes[n + 1:] ])
+            if max_distance is None or spread <= max_distance :
+                result.append((tubes, spread))
+        return sorted(result, key=lambda q: q[1])
+
+def _tube_ranges(filename) :
+    try :
+        tm = tube_map(utracer_data(filename), tube_catalog.make_title(filename))
+        return filename, (tm.va_range(), tm.vg_range(), tm.ia_range()), None
+    except Exception as exc :
+        return filename, None, '%s: %s' % (type(exc).__name__, exc)
+
+def _tube_features(args) :
+    filename, points = args
+    try :
+        return filename, points.features(tube_map(utracer_data(filename), tube_catalog.make_title(filename))), None
+    except Exception as exc :
+        return filename, None, '%s: %s' % (type(exc).__name__, exc)
+
+def match_files(paths, workers=None, points=None, weights=None) :
+    """
+    Load the sweep files in paths (files or directories) in a pool of
+    worker processes and return a tube_matcher for them, and a list of
+    (filename, error) for files that couldn't be used. The files are
+    read twice, first for their ranges, to choose the shared points
+    (leaving out any tubes whose ranges don't overlap the rest, see
+    overlapping), then for their features; the second time the fitted models come
+    from the cache. Only the feature vectors are sent back from the
+    workers, so memory doesn't depend on the size of the tube_maps.
+    """
+    files = tube_files(paths)
+    with worker_pool(workers, len(files)) as pool :
+        errors = []
+        ranges = []
+        for filename, r, error in pool.imap(_tube_ranges, files) :
+            if error :
+                errors.append((filename, error))
+            else :
+                ranges.append((filename, r))
+        if not ranges :
+            return None, errors
+        keep = overlapping([ r for f, r in ranges ])
+        errors += [ (f, "its Va and Vg ranges don't overlap the other tubes'")
+                    for n, (f, r) in enumerate(ranges) if n not in set(keep) ]
+        ranges = [ ranges[n] for n in keep ]
+        mp = match_points.common([ r for f, r in ranges ], points=points, weights=weights)
+        names, features = [], []
+        for filename, f, error in pool.imap(_tube_features, [ (f, mp) for f, r in ranges ]) :
+            if error :
+                errors.append((filename, error))
+            else :
+                names.append(filename)
+                features.append(f)
+    return tube_matcher(names, np.array(features), mp), errors
+
+# Stand-alone use: match the tubes in the given files and directories into
+# pairs (or quads), best first.
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    parser = ArgumentParser(usage='[options] file-or-directory...')
+    parser.add_argument('-q', '--quads', action='store_true', help='Match quads rather than pairs')
+    parser.add_argument('-m', '--max-distance', type=float, default=None,
+                        help='Only show matches within this distance (RMS relative difference)')
+    parser.add_argument('-n', '--grid-points', type=int, default=None, help='Va and Vg values in the shared grid')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('-C', '--no-cache', action='store_true', help="Don't use or write parsed data and model caches")
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+    if args.no_cache :
+        utracer_data.use_cache = tube_map.use_cache = False
+    start = time.time()
+    try :
+        matcher, errors = match_files(args.paths, workers=args.workers, points=args.grid_points)
+    except ValueError as exc :
+        print >>sys.stderr, exc
+        sys.exit(1)
+    for filename, error in errors :
+        print >>sys.stderr, "%s: %s" % (filename, error)
+    if matcher :
+        if args.quads :
+            for n, (tubes, d) in enumerate(matcher.quads(args.max_distance)) :
+                print "%4d %.4f %s" % (n + 1, d, '  '.join([ matcher.names[t] for t in tubes ]))
+        else :
+            for n, (i, j, d) in enumerate(matcher.pairs(args.max_distance)) :
+                print "%4d %.4f %s  %s" % (n + 1, d, matcher.names[i], matcher.names[j])
+    print >>sys.stderr, "%d tubes, %d errors, %.3f s" % (len(matcher.names) if matcher else 0, len(errors),
+                                                          time.time() - start)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,84 @@
+import threading
+import traceback
+from Queue import Queue, Empty
+
+class plot_worker(object) :
+    """
+    Runs plot computations on a background thread, so that the Tk main
+    loop carries on while they run. submit() queues a job, cancelling
+    any job that is still waiting or running. Tk isn't thread safe, so
+    the results are collected on the main thread by polling with after(),
+    and the done (or failed) callback is called there.
+
+    A job that is already running can't be stopped, but its result is
+    thrown away when it finishes. There is only one thread, so a tube_map
+    (and its point cache) is never used by two computations at once.
+    """
+
+    POLL_MS = 50
+
+    class job(object) :
+
+        def __init__(self, number, fn, done, failed) :
+            self.number, self.fn, self.done, self.failed = number, fn, done, failed
+
+    def __init__(self, tk_widget, poll_ms=None) :
+        self.tk_widget = tk_widget
+        self.poll_ms = poll_ms or plot_worker.POLL_MS
+        self.jobs, self.results = Queue(), Queue()
+        self.current = 0                # number of the latest job
+        self.pending = None             # number of the job whose result we are waiting for
+        self.polling = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, fn, done, failed=None) :
+        """
+        Run fn() in the background, then call done(result) (or failed(exc),
+        if fn raised an exception) in the main thread, unless the job has
+        been cancelled or replaced by then.
+        """
+        self.current += 1
+        self.pending = self.current
+        self.jobs.put(plot_worker.job(self.current, fn, done, failed))
+        if not self.polling :
+            self.polling = True
+            self.tk_widget.after(self.poll_ms, self._poll)
+
+    def cancel(self) :
+        self.current += 1
+        self.pending = None
+
+    def busy(self) :
+        return self.pending is not None
+
+    def _run(self) :
+        while True :
+            job = self.jobs.get()
+            if job.number != self.current :
+                continue                # cancelled or replaced while waiting
+            try :
+                result, exc = job.fn(), None
+            except Exception as exc :
+                result = None
+                traceback.print_exc()
+            self.results.put((job, result, exc))
+
+    def _poll(self) :
+        try :
+            while True :
+                job, result, exc = self.results.get_nowait()
+                if job.number != self.pending :
+                    continue
+                self.pending = None
+                if exc is None :
+                    job.done(result)
+                elif job.failed :
+                    job.failed(exc)
+        except Empty :
+            pass
+        if self.pending is not None :
+            self.tk_widget.after(self.poll_ms, self._poll)
+        else :
+            self.polling = False
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+import sys
+import json
+import threading
+import numpy as np
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from catalog import tube_catalog
+from range import range
+
+DEFAULT_PORT = 8765
+DEFAULT_MEMORY = 256            # MB
+
+class tube_pool(object) :
+    """
+    The tube_maps held by the server, loaded on demand from the catalog of
+    the data directory and kept in least-recently-used order. Whenever a
+    tube is loaded or a query has been answered, the least recently used
+    tubes are dropped until the estimated memory (see tube_map.memory_size)
+    is under the limit, always keeping the one most recently used.
+
+    Tubes are named as in the catalog: an exact title, or any pattern that
+    matches just one tube.
+    """
+
+    def __init__(self, directory, memory=DEFAULT_MEMORY, point_cache=True) :
+        self.catalog = tube_catalog(directory)
+        self.memory_limit = memory * 1024 * 1024
+        self.point_cache = point_cache
+        self.tubes = OrderedDict()
+        self.loads = self.evictions = 0
+
+    def find(self, name) :
+        found = self.catalog.find(name)
+        exact = [ r for r in found if r['title']==name.upper() ]
+        if not found :
+            raise KeyError("no tube matching '%s'" % (name,))
+        if len(exact or found) > 1 :
+            raise KeyError("'%s' matches more than one tube: %s" %
+                           (name, ', '.join([ r['title'] for r in (exact or found) ])))
+        return (exact or found)[0]
+
+    def get(self, name) :
+        record = self.find(name)
+        try :
+            tm = self.tubes.pop(record['filename'])
+        except KeyError :
+            tm = self.catalog.open(record)
+            if self.point_cache :
+                tm.enable_point_cache()
+            self.loads += 1
+        self.tubes[record['filename']] = tm
+        return tm
+
+    def memory_size(self) :
+        return sum([ tm.memory_size() for tm in self.tubes.itervalues() ])
+
+    def trim(self) :
+        while len(self.tubes) > 1 and self.memory_size() > self.memory_limit :
+            self.tubes.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) :
+        return { 'tubes' : [ tm.title for tm in self.tubes.itervalues() ],
+                 'memory' : self.memory_size(),
+                 'memory_limit' : self.memory_limit,
+                 'loads' : self.loads,
+                 'evictions' : self.evictions }
+
+def _array(query, name, default=None) :
+    value = query.get(name, default)
+    if value is None :
+        raise ValueError("query needs a value for '%s'" % (name,))
+    return np.asarray(value, dtype=float)
+
+def _json(value) :
+    if isinstance(value, np.ndarray) :
+        return value.tolist()
+    if isinstance(value, np.generic) :
+        return value.item()
+    return value
+
+def do_ia(tm, q) :
+    return { 'Ia' : tm.ia(_array(q, 'Va'), _array(q, 'Vg')) }
+
+def do_derivatives(tm, q) :
+    gm, rp, mu = tm.derivatives(_array(q, 'Va'), _array(q, 'Vg'))
+    return { 'gm' : gm, 'rp' : rp, 'mu' : mu }
+
+def do_load_line(tm, q) :
+    eb, rl = float(q.get('Eb', 0)), float(q.get('Rl', 0))
+    ia = q.get('Ia')
+    if not ia :
+        ia = tm.ia_max()
+        if eb and rl :
+            # the load line can't go beyond where it crosses the highest Vg curve
+            ia = min(ia, float(tm.load_line_point(eb, rl, tm.vg_max())[1]))
+    derivs = tm.get_derivatives(Eb=eb, Rl=rl,
+                                Va=float(q.get('Va', 0)), Vg=float(q.get('Vg', 0)),
+                                Ia=range(*ia) if isinstance(ia, list) else range(float(ia)),
+                                points=q.get('points'), method=q.get('method'))
+    return dict(zip(['Ia', 'gm', 'rp', 'mu', 'Va', 'Vg', 'failed'], derivs))
+
+def do_Vg_from_Ia(tm, q) :
+    vg, failed = tm.Vg_from_Ia_array(_array(q, 'Va'), _array(q, 'Ia'))
+    return { 'Vg' : vg, 'failed' : failed }
+
+def do_Va_from_Ia(tm, q) :
+    va, failed = tm.Va_from_Ia_array(_array(q, 'Vg'), _array(q, 'Ia'))
+    return { 'Va' : va, 'failed' : failed }
+
+def do_info(tm, q) :
+    return { 'title' : tm.title,
+             'va_range' : tm.va_range(), 'vg_range' : tm.vg_range(), 'ia_range' : tm.ia_range(),
+             'point_cache' : tm.point_cache_stats(), 'memory' : tm.memory_size() }
+
+OPERATIONS = { 'ia' : do_ia,
+               'derivatives' : do_derivatives,
+               'load_line' : do_load_line,
+               'Vg_from_Ia' : do_Vg_from_Ia,
+               'Va_from_Ia' : do_Va_from_Ia,
+               'info' : do_info }
+
+class tube_server(ThreadingMixIn, HTTPServer) :
+    """
+    HTTP/JSON front end for a tube_pool. POST a query, or a list of them,
+    to /query; the reply is the result, or a list of results in the same
+    order. A query is an object with 'tube', 'op' (one of OPERATIONS) and
+    the op's arguments, e.g.
+
+        {"tube": "6sn7", "op": "ia", "Va": [100, 200], "Vg": -4}
+        {"tube": "6sn7", "op": "load_line", "Eb": 250, "Rl": 10, "points": 10}
+        {"tube": "6sn7", "op": "Vg_from_Ia", "Va": 200, "Ia": [2, 5, 10]}
+
+    Array arguments broadcast against each other. A query that fails gets
+    {"error": "..."} as its result, without affecting the rest of the batch.
+    GET /tubes lists the catalog, GET /stats gives the pool statistics.
+
+    Connections are handled in threads, but tube_maps (and their caches)
+    aren't thread safe, so queries are answered one at a time.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    verbose = False
+
+    def __init__(self, address, pool) :
+        HTTPServer.__init__(self, address, tube_request_handler)
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def answer(self, query) :
+        if not isinstance(query, dict) :
+            return { 'error' : 'a query must be a JSON object' }
+        try :
+            op = query.get('op', 'ia')
+            if not isinstance(op, basestring) or op not in OPERATIONS :
+                return { 'error' : "unknown op '%s'" % (op,) }
+            try :
+                tm = self.pool.get(query['tube'])
+            except KeyError as exc :
+                return { 'error' : exc.args[0] if exc.args[0] != 'tube' else "query needs a 'tube'" }
+            except (IOError, OSError, ValueError) as exc :
+                return { 'error' : "can't load '%s': %s: %s" % (query['tube'], type(exc).__name__, exc) }
+            result = OPERATIONS[op](tm, query)
+            return dict([ (k, _json(v)) for k, v in result.iteritems() ])
+        except Exception as exc :
+            return { 'error' : '%s: %s' % (type(exc).__name__, exc) }
+
+    def answer_all(self, request) :
+        with self.lock :
+            if isinstance(request, list) :
+                result = [ self.answer(q) for q in request ]
+            else :
+                result = self.answer(request)
+            self.queries += len(request) if isinstance(request, list) else 1
+            self.pool.trim()
+        return result
+
+    def stats(self) :
+        with self.lock :
+            result = self.pool.stats()
+            result['queries'] = self.queries
+        return result
+
+class tube_request_handler(BaseHTTPRequestHandler) :
+
+    protocol_version = 'HTTP/1.1'       # keep connections open between requests
+    wbufsize = -1                       # send each reply in one go, or Nagle and delayed ACK cost 40 ms
+
+    def do_GET(self) :
+        if self.path == '/tubes' :
+            self.reply(200, [ r for r in self.server.pool.catalog.find() ])
+        elif self.path == '/stats' :
+            self.reply(200, self.server.stats())
+        else :
+            self.reply(404, { 'error' : 'no such resource %s' % (self.path,) })
+
+    def do_POST(self) :
+        if self.path != '/query' :
+            self.reply(404, { 'error' : 'no such resource %s' % (self.path,) })
+            return
+        try :
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as exc :
+            self.reply(400, { 'error' : 'bad JSON: %s' % (exc,) })
+            return
+        self.reply(200, self.server.answer_all(request))
+
+    def reply(self, code, value) :
+        body = json.dumps(value)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) :
+        if self.server.verbose :
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    parser = ArgumentParser(usage='[options] data-directory')
+    parser.add_argument('-p', '--port', type=int, default=DEFAULT_PORT, help='Port to listen on')
+    parser.add_argument('-H', '--host', default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('-m', '--memory', type=float, default=DEFAULT_MEMORY,
+                        help='Memory limit for the loaded tubes (MB)')
+    parser.add_argument('-N', '--no-point-cache', action='store_true', help="Don't cache point queries")
+    parser.add_argument('-v', '--verbose', action='store_true', help='Log each request')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    server = tube_server((args.host, args.port), tube_pool(args.directory, args.memory, not args.no_point_cache))
+    server.verbose = args.verbose
+    print "serving %d tubes from %s on http://%s:%d/" % \
+          (len(server.pool.catalog.find()), args.directory, args.host, args.port)
+    sys.stdout.flush()
+    try :
+        server.serve_forever()
+    except KeyboardInterrupt :
+        pass
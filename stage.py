@@ -0,0 +1,181 @@
+#!/usr/bin/python
+import sys
+import time
+import numpy as np
+from tube_map import tube_map
+
+# Distortion of a common cathode stage: the grid is driven with a sine wave
+# about the bias point and the anode voltage follows the plate curves
+# along the load line for Eb and Rl. The stage is treated as memoryless
+# (no capacitances), so the frequency only sets the time axis. If a
+# cathode resistor is given it sets the bias and is taken to be fully
+# bypassed, so that the cathode stays at its quiescent voltage.
+#
+# The anode voltage is found from a transfer curve, Va against Vg along
+# the load line, solved once for each load at TRANSFER_POINTS grid
+# voltages and then interpolated, so that any number of drive levels
+# costs little more than one.
+#
+# The tube is only known over the measured Vg range, so a swing that goes
+# outside it (or a point that can't be solved) gives results from clamped
+# or extrapolated values. These are marked as failed rather than hidden.
+
+TRANSFER_POINTS = 1024          # grid voltages in the transfer curve
+SAMPLES = 256                   # samples per cycle of the input
+HARMONICS = 10                  # highest harmonic reported
+
+def bias_point(tm, Eb, Rl, Vg=None, Rk=None) :
+    """
+    Return (Eb, Vg) for the AC load line: with a cathode resistor, Vg is
+    its self bias, and Eb is reduced by the (bypassed) cathode voltage.
+    """
+    if Rk is not None :
+        ia, va, vg = tm.self_bias_point(Eb, Rl, Rk)[:3]
+        return Eb - ia * Rk, vg
+    if Vg is None :
+        raise ValueError("need either a grid bias or a cathode resistor")
+    return Eb, Vg
+
+def transfer_curve(tm, Eb, Rl, vg_low, vg_high, points=None) :
+    """
+    Return (vg, va, failed): Va at evenly spaced grid voltages from vg_low
+    to vg_high along the load line. Eb and Rl may be arrays, giving a row
+    of va for each combination. failed marks the points that are outside
+    the measured Vg range, or where the load line couldn't be solved.
+    """
+    vg = np.linspace(vg_low, vg_high, points or TRANSFER_POINTS)
+    Eb, Rl = [ np.asarray(a, dtype=float)[..., np.newaxis] for a in (Eb, Rl) ]
+    va, ia, failed = tm.load_line_point(Eb, Rl, vg)
+    return vg, va, failed | _outside(tm, vg)
+
+def _outside(tm, vg) :
+    low, high = tm.vg_range()
+    return (vg < low) | (vg > high)
+
+def _interpolate(vg, va, x) :
+    """
+    Linear interpolation of evenly spaced transfer curves va (any leading
+    shape) at x, whose leading dimensions match va's.
+    """
+    position = np.clip((x - vg[0]) / (vg[1] - vg[0]), 0, len(vg) - 1.000001)
+    i = position.astype(int)
+    f = position - i
+    flat = va.reshape(-1, va.shape[-1])
+    rows = np.arange(len(flat)).reshape(va.shape[:-1] + (1,) * (x.ndim - va.ndim + 1))
+    return flat[rows, i] * (1 - f) + flat[rows, i + 1] * f
+
+def waveform(tm, Eb, Rl, Vg, amplitude, frequency=1000.0, Rk=None, cycles=1, samples=None) :
+    """
+    Drive the stage with amplitude volts peak at the given frequency, for
+    the given number of cycles, and return (t, vin, vout, failed), where
+    vout is the change in anode voltage from the quiescent point and
+    failed marks the samples outside the measured Vg range or not solved.
+    """
+    Eb, Vg = bias_point(tm, Eb, Rl, Vg, Rk)
+    n = (samples or SAMPLES) * cycles
+    t = np.arange(n) / float(n) * cycles / frequency
+    vin = amplitude * np.sin(2 * np.pi * frequency * t)
+    va, ia, failed = tm.load_line_point(Eb, Rl, Vg + vin)
+    return t, vin, va - tm.load_line_point(Eb, Rl, Vg)[0], failed | _outside(tm, Vg + vin)
+
+def harmonics(vout, cycles=1, count=None) :
+    """
+    Return the peak amplitudes of the fundamental and harmonics up to count
+    in a whole number of cycles of vout (along its last axis), and the
+    THD as a fraction of the fundamental.
+    """
+    count = count or HARMONICS
+    spectrum = np.abs(np.fft.rfft(vout, axis=-1)) * 2 / vout.shape[-1]
+    levels = spectrum[..., cycles * np.arange(1, count + 1)]
+    fundamental = levels[..., 0]
+    thd = np.sqrt((levels[..., 1:] ** 2).sum(axis=-1)) / np.where(fundamental > 0, fundamental, 1)
+    return levels, thd
+
+def sweep(tm, Eb, Rl, amplitude, Vg=None, Rk=None, samples=None) :
+    """
+    Simulate every combination of the loads Rl and drive levels amplitude
+    (peak volts, which must be positive). Returns (gain, levels, thd,
+    failed), each with a row for each load and a column for each
+    amplitude; levels has a further axis for the harmonics, see
+    harmonics(), and failed marks the combinations whose swing leaves the
+    measured Vg range or crosses points that couldn't be solved. The
+    transfer curves for all the loads are solved together, and the
+    waveforms for all the combinations are then interpolated and analysed
+    together.
+    """
+    Rl, amplitude = np.asarray(Rl, dtype=float), np.asarray(amplitude, dtype=float)
+    if (amplitude <= 0).any() :
+        raise ValueError("amplitudes must be positive")
+    Eb, Vg = bias_point(tm, Eb, Rl, Vg, Rk)
+    Eb, Vg = np.broadcast_arrays(Eb, Vg, Rl)[:2]
+    top = amplitude.max()
+    vg, va, failed = transfer_curve(tm, Eb, Rl, Vg.min() - top, Vg.max() + top)
+    n = samples or SAMPLES
+    vin = amplitude[:, np.newaxis] * np.sin(2 * np.pi * np.arange(n) / float(n))
+    grid = Vg[:, np.newaxis, np.newaxis] + vin
+    vout = _interpolate(vg, va, grid)
+    levels, thd = harmonics(vout)
+    gain = levels[..., 0] / amplitude
+    return gain, levels, thd, (_interpolate(vg, failed.astype(float), grid) > 0).any(axis=-1)
+
+# Stand-alone use: show the harmonics for one stage and drive level, or with
+# more than one load or drive level, write a table of gain, THD and the
+# second and third harmonics for every combination.
+
+if __name__=="__main__" :
+    from argparse import ArgumentParser
+    from utracer_data import utracer_data
+    from catalog import tube_catalog
+    from range import range
+    parser = ArgumentParser(usage='[options] data-filename')
+    parser.add_argument('-b', '--Eb', type=float, default=None, help='B+ voltage')
+    parser.add_argument('-l', '--Rl', type=range, default=None, help=u'Load resistor(s) (kohm)')
+    parser.add_argument('-g', '--Vg', type=float, default=None, help='Grid bias')
+    parser.add_argument('-k', '--Rk', type=float, default=None, help='Bypassed cathode resistor (kohm), instead of -g')
+    parser.add_argument('-a', '--amplitude', type=range, default=None, help='Input amplitude(s), volts peak')
+    parser.add_argument('-f', '--frequency', type=float, default=1000.0, help='Input frequency (Hz)')
+    parser.add_argument('-w', '--waveform', action='store_true', help='Write the input and output waveforms')
+    parser.add_argument('file')
+    args = parser.parse_args()
+    tm = tube_map(utracer_data(args.file), tube_catalog.make_title(args.file))
+    eb = args.Eb or tm.va_max() * tube_map.EB_RATIO
+    loads = list(args.Rl or [ round(2 * eb / tm.ia_max(), 1) ])
+    if args.Vg is None and args.Rk is None :
+        args.Vg = tm.vg_min() / 2
+    # a range given as a single value starts at 0, which there is no point in
+    amplitudes = [ a for a in args.amplitude or [ abs(bias_point(tm, eb, loads[0], args.Vg, args.Rk)[1]) / 2.0 ]
+                   if a > 0 ]
+    if not amplitudes :
+        print >>sys.stderr, "no positive amplitudes"
+        sys.exit(1)
+    if args.waveform :
+        t, vin, vout, failed = waveform(tm, eb, loads[0], args.Vg, amplitudes[0], args.frequency, args.Rk)
+        if failed.any() :
+            print >>sys.stderr, "warning: %d samples are outside the measured Vg range %.2f to %.2f V, " \
+                  "or couldn't be solved" % ((failed.sum(),) + tm.vg_range())
+        print 't,Vin,Vout'
+        for r in zip(t, vin, vout) :
+            print '%.7f,%.4f,%.4f' % r
+        sys.exit(0)
+    start = time.time()
+    gain, levels, thd, failed = sweep(tm, eb, loads, amplitudes, args.Vg, args.Rk)
+    elapsed = time.time() - start
+    if failed.any() :
+        print >>sys.stderr, "warning: %d of %d combinations swing the grid outside the measured Vg range " \
+              "%.2f to %.2f V, or couldn't be solved: their results are extrapolated" % \
+              ((failed.sum(), failed.size) + tm.vg_range())
+    if len(loads) == 1 and len(amplitudes) == 1 :
+        print "%s Eb = %.0f V Rl = %.1f kohm %s, %.2f V peak at %.0f Hz" % \
+              (tm.title, eb, loads[0], "Rk = %.2f kohm" % (args.Rk,) if args.Rk is not None
+               else "Vg = %.2f V" % (args.Vg,), amplitudes[0], args.frequency)
+        print "gain %.2f  THD %.3f%%" % (gain[0, 0], thd[0, 0] * 100)
+        for n, h in enumerate(levels[0, 0]) :
+            print "H%-2d %8.4f V %7.1f dB" % (n + 1, h, 20 * np.log10(max(h / levels[0, 0, 0], 1e-12)))
+    else :
+        print 'Rl,Amplitude,Gain,THD_pct,H2_dB,H3_dB,Failed'
+        h = 20 * np.log10(np.maximum(levels[..., 1:3] / np.maximum(levels[..., :1], 1e-12), 1e-12))
+        for i, rl in enumerate(loads) :
+            for j, a in enumerate(amplitudes) :
+                print '%.3f,%.3f,%.3f,%.4f,%.1f,%.1f,%d' % (rl, a, gain[i, j], thd[i, j] * 100, h[i, j, 0], h[i, j, 1],
+                                                           failed[i, j])
+        print >>sys.stderr, "%d combinations in %.3f s" % (len(loads) * len(amplitudes), elapsed)
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+"""
+Measure the wall-clock time of a headless deriv.py run (-o, numeric output
+to stdout), as used from shell pipelines, against the same run with the
+plotting modules loaded up front as deriv.py used to do. Each command is
+run in a fresh interpreter several times and the best and median times
+are reported, together with whether matplotlib was loaded at all.
+
+    python startup_bench.py [-r repeats] [data-file]
+"""
+
+import os
+import sys
+import time
+import subprocess
+from argparse import ArgumentParser
+
+DERIV_ARGS = ['-o', '-b', '250', '-n', '5']
+
+LAZY = "import sys, runpy; sys.argv = %r; runpy.run_path('deriv.py', run_name='__main__'); " \
+       "sys.stderr.write(str('matplotlib' in sys.modules))"
+EAGER = "import graphing; " + LAZY
+
+def run(code, argv) :
+    """
+    Run the code in a new interpreter, returning the elapsed time and
+    whether matplotlib was imported.
+    """
+    start = time.time()
+    p = subprocess.Popen([sys.executable, '-c', code % (argv,)],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    elapsed = time.time() - start
+    if p.returncode :
+        raise Exception("deriv.py failed: %s" % (err.strip(),))
+    return elapsed, err.strip().endswith('True')
+
+def bench(name, code, argv, repeats) :
+    results = [ run(code, argv) for i in xrange(repeats) ]
+    times = sorted([ r[0] for r in results ])
+    print "%-22s best %6.3f s  median %6.3f s  matplotlib loaded: %s" % \
+          (name, times[0], times[len(times) // 2], 'yes' if results[0][1] else 'no')
+    return times[len(times) // 2]
+
+if __name__=="__main__" :
+    parser = ArgumentParser(usage='[options] [data-file]')
+    parser.add_argument('-r', '--repeats', type=int, default=10, help='Number of runs of each command')
+    parser.add_argument('file', nargs='?', default=os.path.join('data', '6sn7'))
+    args = parser.parse_args()
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    argv = ['deriv.py'] + DERIV_ARGS + [args.file]
+    run(LAZY, argv)                     # make sure the caches are built
+    eager = bench('plotting imported', EAGER, argv, args.repeats)
+    lazy = bench('deriv.py -o', LAZY, argv, args.repeats)
+    print "saved %.3f s per run (%.0f%%)" % (eager - lazy, 100.0 * (eager - lazy) / eager)
@@ -3,37 +3,314 @@ import scipy.interpolate
 import numpy as np
 from utility import *
 import math
+import os
+import zipfile
 from copy import copy
 
-class tube_map:
+class deriv_map(object):
+    """
+    gm, rp and mu (and Ia) on a grid of evenly spaced Va and Vg values,
+    each an array with a row per Va value, as made by
+    tube_map.derivative_map(). mask marks the points where Ia is too small
+    for the derivatives to mean much. at() interpolates them bilinearly.
+    """
+
+    def __init__(self, va, vg, ia, gm, rp, mu, mask, method):
+        self.va, self.vg, self.ia, self.gm, self.rp, self.mu, self.mask = va, vg, ia, gm, rp, mu, mask
+        self.points, self.method = len(va), method
+        # interpolate the conductance rather than rp, which jumps to 0 at cutoff
+        invrp = np.where(rp > 0, 1 / np.where(rp > 0, rp, 1), 0.0)
+        self._table = np.array([gm, invrp, mu])
+
+    def nbytes(self):
+        return sum([ a.nbytes for a in (self.va, self.vg, self.ia, self.gm, self.rp, self.mu, self.mask,
+                                        self._table) ])
+
+    def at(self, Va, Vg):
+        """
+        Return (gm, rp, mu) at the given points, which may be arrays and
+        are broadcast against each other. Points outside the map take the
+        value at its edge.
+        """
+        Va, Vg = np.broadcast_arrays(np.asarray(Va, dtype=float), np.asarray(Vg, dtype=float))
+        indices = []
+        for x, grid in ((Va, self.va), (Vg, self.vg)) :
+            position = np.clip((x - grid[0]) / (grid[1] - grid[0]), 0, len(grid) - 1.000001)
+            i = position.astype(int)
+            indices.append((i, position - i))
+        (i, fi), (j, fj) = indices
+        n = len(self.vg)
+        k = i * n + j
+        t = self._table.reshape(3, -1)
+        gm, invrp, mu = (t.take(k, axis=1) * (1 - fj) + t.take(k + 1, axis=1) * fj) * (1 - fi) + \
+                        (t.take(k + n, axis=1) * (1 - fj) + t.take(k + n + 1, axis=1) * fj) * fi
+        rp = np.where(invrp > 0, 1 / np.where(invrp > 0, invrp, 1), 0.0)
+        return (gm, rp, mu)
+
+class tube_map(object):
     MIN_DERIV_VA = 0.85       # lowest proportion of Eb to use when calculating derivatives
     MIN_DERIV_VG = 0.3       # highest (lowest) Vg to use for derivatives
     MIN_DERIV_IA = 0.05      # lowest Ia to use when calculating derivatives
     EB_RATIO = 0.95           # fraction of max Va to use for Eb
     DERIV_POINTS = 20        # number of points to calculate for derivatives
     DERIV_DELTA = 0.005       # delta multiplier for differential calculation
+    DERIV_METHOD = 'analytic' # 'analytic' (spline derivatives), 'difference' or 'map' (the derivative map)
+    DERIV_MAP = False         # answer derivatives() from the precomputed derivative map
+    DERIV_MAP_POINTS = 200    # grid size (in each direction) for the derivative map
+    INVERSE_TABLES = True     # use precomputed inverse surfaces for Va_from_Ia and Vg_from_Ia
+    INVERSE_POINTS = 100      # grid size (in each direction) for the inverse surfaces
+    INVERSE_REFINE = True     # refine inverse lookups with a Newton step on the forward spline
+    POINT_CACHE_SIZE = 10000  # default number of entries for enable_point_cache()
+    POINT_CACHE_RESOLUTION = 1e-4   # default quantization of point cache keys (V or mA)
+    IA_CLAMP = 1e-3           # currents below this are treated as 0
+    SPLINE_DEGREE = 3         # spline degree, reduced to 2 in Va for very short sweeps
+    MODEL_VERSION = 1         # change this if the fit or the saved model changes
+    MODEL_SUFFIX = '.tm.npz'
+    use_cache = True
 
-    def __init__(self, udata, title):
-        self.va, self.vg, self.data = udata.get()
-        self.original_va, self.original_vg = copy(self.va), copy(self.vg)
-        self._ia_min, self._ia_max = flatten_min(self.data), flatten_max(self.data)
+    def __init__(self, udata, title, use_cache=None):
+        """
+        Fit the spline for the given utracer_data. If use_cache is set
+        (by default it follows tube_map.use_cache) the fitted model is
+        saved next to the source file and reused on later loads, as long
+        as the source content and the fit settings haven't changed.
+        """
         self.udata = udata
         self.title = title
+        if use_cache is None :
+            use_cache = tube_map.use_cache
+        if not (use_cache and self._load_model()) :
+            self._fit()
+            if use_cache :
+                self._save_model()
+
+    def _set_source(self):
+        """
+        Take the axes, data and ranges from the source data, ready for
+        _fit, and clear anything derived from an earlier model.
+        """
+        self.va, self.vg, self.data = self.udata.get()
+        self._source_hash = self.udata.content_hash
+        self.original_va, self.original_vg = copy(self.va), copy(self.vg)
+        self._ia_min, self._ia_max = flatten_min(self.data), flatten_max(self.data)
+        self._reset_caches()
+
+    def _reset_caches(self):
+        self._inverse = None
+        self._deriv_map = None
+        self.point_cache = None
+
+    def _fit(self):
+        self._set_source()
         if False :
             print self.va
             print self.vg
             for d in self.data :
                 print '    ', d
         self.extend_data_slope()
-        degree = 3 if len(self.va) > 3 else 2
-        self.interp = scipy.interpolate.RectBivariateSpline(self.va, self.vg, np.array(self.data), kx=degree)
+        self._default_ia = self.data[-3][-3]        # a good data point for mu()
+        degree = tube_map.SPLINE_DEGREE if len(self.va) > 3 else 2
+        self.interp = scipy.interpolate.RectBivariateSpline(self.va, self.vg, np.array(self.data),
+                                                            kx=degree, ky=tube_map.SPLINE_DEGREE)
+
+    def fit_settings(self):
+        return np.array([tube_map.MODEL_VERSION, tube_map.SPLINE_DEGREE])
+
+    def model_filename(self):
+        return self.udata.filename + tube_map.MODEL_SUFFIX
+
+    def save(self, filename):
+        """
+        Save the fitted model, so that load() can recreate it without
+        the source data and without refitting.
+        """
+        tx, ty, c = self.interp.tck
+        with open(filename, 'wb') as f :
+            np.savez(f, settings=self.fit_settings(),
+                     source_hash=self._source_hash,
+                     title=self.title,
+                     tx=tx, ty=ty, c=c, degrees=self.interp.degrees,
+                     va=self.va, vg=self.vg,
+                     original_va=self.original_va, original_vg=self.original_vg,
+                     ia_bounds=[self._ia_min, self._ia_max],
+                     default_ia=self._default_ia)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Recreate a tube_map from a file written by save().
+        """
+        self = cls.__new__(cls)
+        self.udata = None
+        with np.load(filename) as model :
+            self._restore(model)
+            self.title = model['title'].item()
+        return self
+
+    def _restore(self, model):
+        tx, ty, c = model['tx'], model['ty'], model['c']
+        kx, ky = model['degrees']
+        try :
+            # _from_tck is scipy internal, so if it has gone or changed the cache is just stale
+            self.interp = scipy.interpolate.RectBivariateSpline._from_tck((tx, ty, c, int(kx), int(ky)))
+        except (AttributeError, TypeError) as exc :
+            raise ValueError("can't rebuild the saved spline: %s" % (exc,))
+        self._restore_source(model)
+        self.original_va, self.original_vg = model['original_va'].tolist(), model['original_vg'].tolist()
+
+    def _restore_source(self, model):
+        """
+        The saved counterpart of _set_source: the axes, ranges and source
+        hash come from the model, and there is no data.
+        """
+        self.va, self.vg = model['va'].tolist(), model['vg'].tolist()
+        self._ia_min, self._ia_max = model['ia_bounds'].tolist()
+        self._default_ia = float(model['default_ia'])
+        self._source_hash = model['source_hash'].item()
+        self.data = None
+        self._reset_caches()
+
+    def _load_model(self):
+        """
+        Load the cached model for our source file, returning False if there
+        isn't one or if it was made from different data or fit settings.
+        """
+        try :
+            with np.load(self.model_filename()) as model :
+                if not np.array_equal(model['settings'], self.fit_settings()) \
+                        or model['source_hash'].item() != self.udata.content_hash :
+                    return False
+                self._restore(model)
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile) :
+            return False
+        return True
+
+    def _save_model(self):
+        write_cache(self.save, self.model_filename())
+
+    @classmethod
+    def purge_cache(cls, directory) :
+        """
+        Remove every model of this class saved in the directory. Return the
+        number removed.
+        """
+        count = 0
+        for f in os.listdir(directory) :
+            if f.endswith(cls.MODEL_SUFFIX) :
+                os.remove(os.path.join(directory, f))
+                count += 1
+        return count
 
     def __call__(self, Va, Vg):
+        return self._cached('ia', self._point, Va, Vg)
+
+    def _point(self, Va, Vg):
         result = float(self.interp.ev(Va, Vg))
-        if result < 1e-3 :
+        if result < tube_map.IA_CLAMP :
             result = 0
         return result
 
+    def enable_point_cache(self, size=None, resolution=None):
+        """
+        Memoize point queries (__call__, surface and the Va/Vg from Ia
+        solvers) in an LRU cache of the given size. Inputs are quantized
+        to the given resolution to make the keys, so a query within
+        resolution of an earlier one returns the earlier result. Cached
+        arrays are shared, so callers must not modify them.
+        """
+        self.point_cache = lru_cache(size or tube_map.POINT_CACHE_SIZE)
+        self.point_cache_resolution = resolution or tube_map.POINT_CACHE_RESOLUTION
+
+    def disable_point_cache(self):
+        self.point_cache = None
+
+    def clear_point_cache(self):
+        if self.point_cache is not None :
+            self.point_cache.clear()
+
+    def point_cache_stats(self):
+        """
+        Return a dict of hits, misses, hit_rate, entries and size for the
+        point cache, or None if it isn't enabled.
+        """
+        return self.point_cache.stats() if self.point_cache is not None else None
+
+    def memory_size(self):
+        """
+        Return a rough estimate in bytes of the memory held by the map:
+        the spline, the source data, the inverse tables and derivative map
+        if they have been made, and the point cache contents.
+        """
+        size = self._model_size()
+        if self._deriv_map is not None :
+            size += self._deriv_map.nbytes()
+        size += 8 * (len(self.va) + len(self.vg) + len(self.original_va) + len(self.original_vg))
+        if self.data is not None :
+            size += 40 * len(self.data) * len(self.data[0])      # lists of Python floats
+        if self.point_cache is not None :
+            for key, value in self.point_cache.entries.iteritems() :
+                size += 200 + sum([ len(k[1]) for k in key[2:] if isinstance(k, tuple) ])
+                size += np.asarray(value).nbytes if not isinstance(value, tuple) \
+                        else sum([ np.asarray(v).nbytes for v in value ])
+        return size
+
+    def _model_size(self):
+        size = sum([ a.nbytes for a in self.interp.tck ])
+        if self._inverse is not None :
+            size += sum([ a.nbytes for i in self._inverse for a in i.tck ])
+        return size
+
+    def _cached(self, kind, fn, *args, **kwargs):
+        if self.point_cache is None :
+            return fn(*args, **kwargs)
+        key = (kind, tuple(sorted(kwargs.items()))) + \
+              tuple([ self._quantize(np.asarray(a, dtype=float)) for a in args ])
+        try :
+            return self.point_cache[key]
+        except KeyError :
+            result = fn(*args, **kwargs)
+            self.point_cache[key] = result
+            return result
+
+    def _quantize(self, values):
+        q = np.round(values / self.point_cache_resolution).astype(np.int64)
+        return int(q) if q.ndim == 0 else (q.shape, q.tostring())
+
+    def ia(self, Va, Vg):
+        """
+        Array version of __call__: Va and Vg can be anything numpy can
+        broadcast against each other, e.g. a pair of meshgrids. The whole
+        result is calculated with a single spline evaluation.
+        """
+        result = self.interp.ev(Va, Vg)
+        return np.where(result < tube_map.IA_CLAMP, 0.0, result)
+
+    def surface(self, Va, Vg):
+        """
+        Return Ia for every combination of the given Va and Vg values,
+        as an array with one row per Va value.
+        """
+        return self._cached('surface', self._surface, Va, Vg)
+
+    def _surface(self, Va, Vg):
+        return self.ia(np.asarray(Va, dtype=float)[:, np.newaxis], np.asarray(Vg, dtype=float))
+
+    def plate_curves(self, Vg):
+        """
+        Return a function which takes an array of Va values and returns Ia
+        along them for each of the given Vg values, one row per Vg, in a
+        single spline evaluation. This is the form of model that graphing
+        samples. It goes through surface(), so repeated plots come from
+        the point cache if it is enabled.
+        """
+        return lambda va: self.surface(va, Vg).T
+
+    def grid_curves(self, Va):
+        """
+        As plate_curves, but for a function of Vg, one row per Va value.
+        """
+        return lambda vg: self.surface(Va, vg)
+
     def va_range(self):
         return (self.va_min(), self.va_max())
 
@@ -80,10 +357,137 @@ class tube_map:
         return (min(self.vg), max(self.vg))
 
     def Va_from_Ia(self, Vg, Ia):
-        return x_from_y(lambda va: self(va, Vg), self.va_range(), Ia)
+        return self._cached('va', self._Va_from_Ia, Vg, Ia)
+
+    def _Va_from_Ia(self, Vg, Ia):
+        if tube_map.INVERSE_TABLES :
+            return float(self.Va_from_Ia_table(Vg, Ia))
+        return x_from_y(lambda va: self._point(va, Vg), self.va_range(), Ia)
 
     def Vg_from_Ia(self, Va, Ia):
-        return x_from_y(lambda vg: self(Va, vg), self.vg_range(), Ia)
+        return self._cached('vg', self._Vg_from_Ia, Va, Ia)
+
+    def _Vg_from_Ia(self, Va, Ia):
+        if tube_map.INVERSE_TABLES :
+            return float(self.Vg_from_Ia_table(Va, Ia))
+        return x_from_y(lambda vg: self._point(Va, vg), self.vg_range(), Ia)
+
+    def _inverse_tables(self):
+        """
+        Return the interpolators for the inverse maps Vg(Va, Ia) and Va(Vg, Ia),
+        making them the first time they are needed. Each is a bilinear
+        interpolation over a grid of Ia and Va (or Vg), whose values are
+        found by bisection on the forward spline. The Ia grid starts at
+        IA_CLAMP, since below that the inverse isn't defined, and is
+        quadratically spaced, since Vg varies roughly as Ia ** (2/3)
+        and so changes fastest near cutoff.
+        """
+        if self._inverse is None :
+            n = tube_map.INVERSE_POINTS
+            ia_low = max(self.ia_min(), tube_map.IA_CLAMP)
+            ia = ia_low + (self.ia_max() - ia_low) * np.linspace(0, 1, n) ** 2
+            va = np.linspace(self.va_min(), self.va_max(), n)
+            vg = np.linspace(self.vg_min(), self.vg_max(), n)
+            vg_table = self.Vg_from_Ia_array(va[:, np.newaxis], ia)[0]
+            va_table = self.Va_from_Ia_array(vg[:, np.newaxis], ia)[0]
+            self._inverse = (scipy.interpolate.RectBivariateSpline(va, ia, vg_table, kx=1, ky=1),
+                             scipy.interpolate.RectBivariateSpline(vg, ia, va_table, kx=1, ky=1))
+        return self._inverse
+
+    def _refine(self, x, Ia, ia, slope, bounds):
+        """
+        One safeguarded Newton step towards Ia, given the current value ia
+        and its slope at x. The step is limited to one grid cell of the
+        inverse table and the result to the bounds.
+        """
+        cell = (bounds[1] - bounds[0]) / (tube_map.INVERSE_POINTS - 1)
+        step = np.where(slope > 0, (Ia - ia) / np.where(slope > 0, slope, 1), 0.0)
+        return np.clip(x + np.clip(step, -cell, cell), bounds[0], bounds[1])
+
+    def Va_from_Ia_table(self, Vg, Ia, refine=None):
+        """
+        Array lookup of Va from the precomputed inverse surface. If refine is set
+        (by default tube_map.INVERSE_REFINE) the result is improved with one
+        Newton step on the forward spline.
+        """
+        va = self._inverse_tables()[1].ev(Vg, Ia)
+        if refine is None and tube_map.INVERSE_REFINE or refine :
+            va = self._refine(va, Ia, self.interp.ev(va, Vg), self.interp.ev(va, Vg, dx=1), self.va_range())
+        return va
+
+    def Vg_from_Ia_table(self, Va, Ia, refine=None):
+        """
+        Array lookup of Vg from the precomputed inverse surface, see Va_from_Ia_table.
+        """
+        vg = self._inverse_tables()[0].ev(Va, Ia)
+        if refine is None and tube_map.INVERSE_REFINE or refine :
+            vg = self._refine(vg, Ia, self.interp.ev(Va, vg), self.interp.ev(Va, vg, dy=1), self.vg_range())
+        return vg
+
+    def Va_from_Ia_array(self, Vg, Ia, **kwargs):
+        """
+        Array version of Va_from_Ia. Vg and Ia are broadcast against each
+        other and all the points are solved together. Returns (Va, failed),
+        where failed marks the points whose Ia can't be reached within the
+        sweep, or that did not converge. The keyword
+        arguments (rtol, atol, max_iterations) are passed to x_from_y_array.
+        """
+        return self._cached('va_array', self._Va_from_Ia_array, Vg, Ia, **kwargs)
+
+    def _Va_from_Ia_array(self, Vg, Ia, **kwargs):
+        Vg, Ia = np.broadcast_arrays(np.asarray(Vg, dtype=float), np.asarray(Ia, dtype=float))
+        return x_from_y_array(lambda va: self.ia(va, Vg), self.va_range(), Ia, **kwargs)
+
+    def Vg_from_Ia_array(self, Va, Ia, **kwargs):
+        """
+        Array version of Vg_from_Ia, see Va_from_Ia_array.
+        """
+        return self._cached('vg_array', self._Vg_from_Ia_array, Va, Ia, **kwargs)
+
+    def _Vg_from_Ia_array(self, Va, Ia, **kwargs):
+        Va, Ia = np.broadcast_arrays(np.asarray(Va, dtype=float), np.asarray(Ia, dtype=float))
+        return x_from_y_array(lambda vg: self.ia(Va, vg), self.vg_range(), Ia, **kwargs)
+
+    def load_line_point(self, Eb, Rl, Vg, **kwargs):
+        """
+        Find the operating point where the load line for Eb and Rl (kohm)
+        crosses the plate curve for Vg, i.e. Va + Ia * Rl = Eb. The arguments
+        may be arrays, which are broadcast against each other and solved
+        together. With no load resistor Va is just Eb, limited to the
+        sweep's range and marked as failed beyond it. Returns (Va, Ia,
+        failed), see Va_from_Ia_array.
+        """
+        Eb, Rl, Vg = np.broadcast_arrays(*[ np.asarray(v, dtype=float) for v in (Eb, Rl, Vg) ])
+        loaded = Rl > 0
+        rl = np.where(loaded, Rl, 1)
+        va, failed = x_from_y_array(lambda va: np.where(loaded, va + self.ia(va, Vg) * rl, va),
+                                    (self.va_min(), np.minimum(Eb, self.va_max())), Eb, **kwargs)
+        va = np.where(loaded, va, np.clip(Eb, self.va_min(), self.va_max()))
+        return va, self.ia(va, Vg), failed
+
+    def self_bias_point(self, Eb, Rl, Rk, bypassed=True, **kwargs):
+        """
+        Find the operating point of a cathode biased stage: supply Eb, anode
+        load Rl and cathode resistor Rk (both kohm), so that Vg = -Ia * Rk
+        and Va = Eb - Ia * (Rl + Rk). The arguments may be arrays, which are
+        broadcast against each other and all solved together by bisection
+        on Ia. Returns (Ia, Va, Vg, gm, rp, mu, gain, failed), where gain is
+        the voltage gain of the stage with the cathode resistor bypassed,
+        or if bypassed is False, without (when it is mu * Rl / (rp + Rl
+        + (mu + 1) * Rk)). failed marks the points that didn't converge,
+        as for Va_from_Ia_array, and those whose current would be above
+        the sweep's maximum, where Ia is just clamped to it.
+        """
+        Eb, Rl, Rk, bypassed = np.broadcast_arrays(*[ np.asarray(v, dtype=float) for v in (Eb, Rl, Rk, bypassed) ])
+        r = Rl + Rk
+        high = np.where(r > 0, np.minimum(Eb / np.where(r > 0, r, 1), self.ia_max()), self.ia_max())
+        fn = lambda ia: ia - self.ia(Eb - ia * r, -ia * Rk)
+        ia, failed = x_from_y_array(fn, (0, high), np.zeros(Eb.shape), **kwargs)
+        failed |= fn(high) < 0
+        va, vg = Eb - ia * r, -ia * Rk
+        gm, rp, mu = self.derivatives(va, vg)
+        gain = mu * Rl / (rp + Rl + np.where(bypassed, 0, (mu + 1) * Rk))
+        return ia, va, vg, gm, rp, mu, gain, failed
 
     def mu(self, ia=None):
         '''
@@ -91,7 +495,7 @@ class tube_map:
         then tweaking Ia and seeing what the corresponding new Va and Vg
         values are, and taking the ratio.
         '''
-        ia = ia or self.data[-3][-3]           # choose a good data point
+        ia = ia or self._default_ia
         va = self.va_span() / 2
         while True :
             vg = self.Vg_from_Ia(va, ia)
@@ -107,21 +511,102 @@ class tube_map:
         mu = ddva / ddvg
         return mu
 
-    def get_one_derivative(self, Vg, Va, Ia, verbose=False):
+    def derivatives(self, Va, Vg):
+        """
+        Return (gm, rp, mu) at the given points, which may be arrays. If
+        tube_map.DERIV_MAP is set they are interpolated from the derivative
+        map (see derivative_map), otherwise calculated directly.
+        """
+        if tube_map.DERIV_MAP :
+            return self.derivative_map().at(Va, Vg)
+        return self._derivatives(Va, Vg)
+
+    def _derivatives(self, Va, Vg):
+        """
+        gm and 1/rp are the spline's own partial derivatives of Ia with
+        respect to Vg and Va, and mu = gm * rp.
+        """
+        gm = self.interp.ev(Va, Vg, dy=1)
+        invrp = self.interp.ev(Va, Vg, dx=1)
+        rp = np.where(invrp > 0, 1 / np.where(invrp > 0, invrp, 1), 0.0)
+        return (gm, rp, gm * rp)
+
+    def difference_derivatives(self, Va, Vg):
+        """
+        Finite difference version of derivatives(), kept as a cross-check.
+        gm and 1/rp are forward differences, and mu is found by solving for
+        the Va that restores the Ia after a small change in Vg.
+        """
+        Va, Vg = np.broadcast_arrays(np.asarray(Va, dtype=float), np.asarray(Vg, dtype=float))
+        va_delta = np.minimum(np.maximum(Va * 0.05, 1), self.va_span() * tube_map.DERIV_DELTA)
+        vg_delta = np.minimum(np.maximum(Vg * 0.05, 0.05), self.vg_span() * tube_map.DERIV_DELTA)
+        ia = self.ia(Va, Vg)
+        dia = self.ia(Va, Vg + vg_delta)
+        gm = (dia - ia) / vg_delta
+        invrp = (self.ia(Va + va_delta, Vg) - ia) / va_delta
+        rp = np.where(invrp > 0, 1 / np.where(invrp > 0, invrp, 1), 0.0)
+        mu = (self.Va_from_Ia_array(Vg, dia)[0] - Va) / vg_delta
+        return (gm, rp, mu)
+
+    def derivative_map(self, points=None, method=None):
+        """
+        Return the deriv_map of gm, rp and mu over the whole Va x Vg plane,
+        making it the first time it is needed (or if points or method
+        differ from the last one). It has points values of Va and of Vg
+        (by default tube_map.DERIV_MAP_POINTS), evenly spaced over the
+        sweep's ranges, and all of them are calculated in one pass. method
+        is 'analytic' (the default) or 'difference', see derivatives() and
+        difference_derivatives().
+        """
+        points = points or tube_map.DERIV_MAP_POINTS
+        method = method or 'analytic'
+        m = self._deriv_map
+        if m is None or m.points != points or m.method != method :
+            if method == 'analytic' :
+                fn = self._derivatives
+            elif method == 'difference' :
+                fn = self.difference_derivatives
+            else :
+                raise ValueError("unknown derivative map method '%s'" % (method,))
+            va = np.linspace(self.va_min(), self.va_max(), points)
+            vg = np.linspace(self.vg_min(), self.vg_max(), points)
+            ia = self.ia(va[:, np.newaxis], vg)
+            gm, rp, mu = [ np.broadcast_to(d, ia.shape) for d in fn(va[:, np.newaxis], vg) ]
+            self._deriv_map = deriv_map(va, vg, ia, gm, rp, mu, ia < self.ia_max() * tube_map.MIN_DERIV_IA,
+                                        method)
+        return self._deriv_map
+
+    def map_derivatives(self, Va, Vg):
+        """
+        Return (gm, rp, mu) at the given points interpolated from the
+        derivative map, whatever tube_map.DERIV_MAP says.
+        """
+        return self.derivative_map().at(Va, Vg)
+
+    def _derivative_fn(self, method):
+        method = method or tube_map.DERIV_METHOD
+        if method == 'analytic' :
+            return self.derivatives
+        elif method == 'difference' :
+            return self.difference_derivatives
+        elif method == 'map' :
+            return self.map_derivatives
+        else :
+            raise ValueError("unknown derivative method '%s'" % (method,))
+
+    def get_one_derivative(self, Vg, Va, Ia, verbose=False, method=None):
+        """
+        Return (gm, rp, mu, Va, Vg) at the given Ia and either Vg or Va.
+        method is 'analytic' (see derivatives()), 'difference' (see
+        difference_derivatives()) or 'map' (see map_derivatives()). The
+        default is tube_map.DERIV_METHOD.
+        """
         if Vg :
             va = self.Va_from_Ia(Vg, Ia)
         else :
             va = Va
             Vg = self.Vg_from_Ia(va, Ia)
-        va_delta = min(max(va * 0.05, 1), self.va_span() * tube_map.DERIV_DELTA)
-        vg_delta = min(max(Vg * 0.05, 0.05), self.vg_span() * tube_map.DERIV_DELTA)
-        gm = pderiv(lambda vg: self(va, vg), Vg, vg_delta)
-        invrp = pderiv(lambda va: self(va, Vg), va, va_delta)
-        rp = 1 / invrp if invrp > 0 else 0
-        dia = self(va, Vg + vg_delta)
-        vad = self.Va_from_Ia(Vg, dia)
-        dva = vad - va
-        mu = dva / vg_delta
+        gm, rp, mu = [ float(d) for d in self._derivative_fn(method)(va, Vg) ]
         if verbose :
             print '***', Vg, Ia, va, gm, rp, mu
         return (gm, rp, mu, va, Vg)
@@ -130,7 +615,36 @@ class tube_map:
                         min_eb_ratio=None,
                         min_vg_ratio=None,
                         min_ia_ratio=None,
+                        points=None,
+                        method=None,
                         verbose=False) :
+        """
+        Calculate gm, rp and mu at evenly spaced values of Ia, along the load
+        line for Eb and Rl, or at a fixed Va or Vg. The operating points are
+        solved and the derivatives calculated for all the points together.
+        Returns numpy arrays (Ia, gm, rp, mu, Va, Vg, failed), where failed
+        marks the points whose operating point could not be solved; points
+        overrides tube_map.DERIV_POINTS.
+        """
+        (min_ia, max_ia), fn = self.derivative_curves(Eb, Rl, Va, Vg, Ia, min_eb_ratio, min_vg_ratio,
+                                                      min_ia_ratio, method, verbose)
+        x_range = np.linspace(min_ia, max_ia, points or tube_map.DERIV_POINTS)
+        derivs = fn(x_range)
+        return (x_range,) + tuple(derivs[:-1]) + (derivs[-1] > 0,)
+
+    def derivative_curves(self, Eb=0, Rl=0, Va=0, Vg=0, Ia=0,
+                          min_eb_ratio=None,
+                          min_vg_ratio=None,
+                          min_ia_ratio=None,
+                          method=None,
+                          verbose=False) :
+        """
+        The arguments are as for get_derivatives. Returns ((min_ia, max_ia),
+        fn) where fn takes an array of Ia values in that range and returns
+        an array with rows gm, rp, mu, Va, Vg and failed (1 where the
+        operating point could not be solved), so that the curves can be
+        sampled at any points (e.g. by graphing).
+        """
         min_eb_ratio = min_eb_ratio or tube_map.MIN_DERIV_VA
         min_vg_ratio = min_vg_ratio or tube_map.MIN_DERIV_VG
         min_vg = min(1, self.vg_span() * min_vg_ratio)
@@ -145,26 +659,26 @@ class tube_map:
         min_ia = Ia() * min_ia_ratio if Ia.start()==0 else Ia.start()
         if verbose :
             print '!!!', Eb, Rl, Ia, min_ia, Vg, Va, min_eb,  min_vg
-        x_range = np.linspace(min_ia, max_ia, tube_map.DERIV_POINTS)
-        derivs = []
-        for ia in x_range :
-            if Eb :
-                va = Eb - Rl * ia
-                vg = self.Vg_from_Ia(va, ia)
-            elif Va :
-                va = Va
-                vg = self.Vg_from_Ia(va, ia)
-            elif Vg :
-                va = self.Va_from_Ia(Vg, ia)
-                vg = Vg
-            derivs.append(self.get_one_derivative(vg, va, ia, verbose=verbose))
-        zipped = zip(*derivs)
-        gm = zipped[0]
-        rp = zipped[1]
-        mu = zipped[2]
-        va = zipped[3]
-        vg = [ vg for vg in zipped[4]]
-        return (x_range, gm, rp, mu, va, vg)
+        return (min_ia, max_ia), lambda ia: self._derivatives_at(np.asarray(ia, dtype=float), Eb, Rl, Va, Vg,
+                                                                 method, verbose)
+
+    def _derivatives_at(self, x_range, Eb, Rl, Va, Vg, method, verbose):
+        if Eb :
+            va = Eb - Rl * x_range
+            vg, failed = self.Vg_from_Ia_array(va, x_range)
+        elif Va :
+            va = np.full_like(x_range, Va)
+            vg, failed = self.Vg_from_Ia_array(va, x_range)
+        else :
+            va, failed = self.Va_from_Ia_array(Vg, x_range)
+            vg = np.full_like(x_range, Vg)
+        gm, rp, mu = self._derivative_fn(method)(va, vg)
+        if verbose :
+            if failed.any() :
+                print '!!! no convergence for Ia =', x_range[failed]
+            for d in zip(vg, x_range, va, gm, rp, mu) :
+                print '***', ' '.join([ str(dd) for dd in d ])
+        return np.array([gm, rp, mu, va, vg, failed])
 
     def extrapolate_slope(self, x, ia):
         '''
@@ -197,3 +711,40 @@ class tube_map:
         self.vg = [self.vg[0] * 2 - self.vg[1]] + self.vg
         self.data = [ [extra] + ia for extra, ia in zip(extra_x, self.data) ]
 
+
+# Test code - executed if the file is run stand-alone
+#
+# Measures the error of the inverse surface lookups against bisection on the
+# forward spline, for every file in the data directory (or the files given as
+# arguments). Only targets that can actually be reached within the sweep are
+# counted: elsewhere the inverse isn't defined and both methods just clamp.
+# Currents below 1% of the maximum are left out too, since right at cutoff Ia
+# is nearly flat and any of a wide range of voltages is an equally good answer.
+
+def t(filename, samples=5000) :
+    from utracer_data import utracer_data
+    tm = tube_map(utracer_data(filename), filename, use_cache=False)
+    rs = np.random.RandomState(1)
+    va = rs.uniform(tm.va_min(), tm.va_max(), samples)
+    vg = rs.uniform(tm.vg_min(), tm.vg_max(), samples)
+    ia = rs.uniform(tm.ia_max() / 100, tm.ia_max(), samples)
+    vg_ok = (ia > tm.ia(va, tm.vg_min())) & (ia < tm.ia(va, tm.vg_max()))
+    va_ok = (ia > tm.ia(tm.va_min(), vg)) & (ia < tm.ia(tm.va_max(), vg))
+    result = [ filename ]
+    for refine in (False, True) :
+        vg_err = np.abs(tm.Vg_from_Ia_table(va, ia, refine=refine) - tm.Vg_from_Ia_array(va, ia)[0])[vg_ok]
+        va_err = np.abs(tm.Va_from_Ia_table(vg, ia, refine=refine) - tm.Va_from_Ia_array(vg, ia)[0])[va_ok]
+        result += [ vg_err.max(), np.percentile(vg_err, 99), va_err.max(), np.percentile(va_err, 99) ]
+    print '%-18s ' % (result[0],) + '%8.4f %8.4f %8.3f %8.3f   ' * 2 % tuple(result[1:])
+
+if __name__=="__main__" :
+    import sys
+    files = sys.argv[1:] or \
+            sorted(os.path.join('data', f) for f in os.listdir('data') if f.endswith(('.txt', '.utd')))
+    print '%-18s %-38s %s' % ('', 'table only', 'with Newton refinement')
+    print '%-18s ' % ('',) + '%8s %8s %8s %8s   ' * 2 % (('Vg max', 'Vg 99%', 'Va max', 'Va 99%') * 2)
+    for f in files :
+        try :
+            t(f)
+        except ValueError as exc :
+            print '%-18s %s' % (f, exc)
@@ -3,10 +3,13 @@
 from Tkinter import *
 from tube_map import tube_map
 from utracer_data import utracer_data
+from catalog import tube_catalog
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from graphing import single_axis_graph, multi_axis_graph
+from matplotlib.figure import Figure
+from graphing import single_axis_graph, multi_axis_graph, graph_canvas
 from data_element import data_element
 from button_frame import button_frame
+from plot_worker import plot_worker
 from collections import OrderedDict
 from action_type import *
 from globals import *
@@ -22,6 +25,7 @@ class main_panel(Frame) :
 
     def __init__(self) :
         self.tube_map = None
+        tube_map.DERIV_MAP = DERIV_MAP
         Frame.__init__(self, bg=COL_BG)
         self.pack()
         self.master.title('Tube Data')
@@ -29,9 +33,16 @@ class main_panel(Frame) :
         self.control.pack(anchor=N, side=LEFT, expand=False)
         self.data_source_frame = LabelFrame(self.control, text="Tube Data File", bg=COL_BG)
         self.data_source_frame.pack(side=TOP, anchor=W, padx=GLOBAL_PADX, pady=GLOBAL_PADY, fill=X)
-        self.data_source = Entry(self.data_source_frame)
-        self.data_source.pack(side=LEFT, anchor=W, padx=GLOBAL_PADX, pady=GLOBAL_PADY)
+        self.data_source_text = StringVar()
+        self.data_source_text.trace('w', self.filter_change)
+        self.data_source = Entry(self.data_source_frame, textvariable=self.data_source_text)
+        self.data_source.pack(side=TOP, anchor=W, padx=GLOBAL_PADX, pady=GLOBAL_PADY)
         self.data_source.bind('<Return>', self.data_change)
+        self.tube_list = Listbox(self.data_source_frame, height=TUBE_LIST_HEIGHT, exportselection=0)
+        self.tube_list.pack(side=TOP, anchor=W, padx=GLOBAL_PADX, pady=GLOBAL_PADY, fill=X)
+        self.tube_list.bind('<<ListboxSelect>>', self.tube_select)
+        self.catalog = tube_catalog(DATA_DIRECTORY)
+        self.filter_change()
         self.op = StringVar()
         self.op.trace('w', self.op_change)
         lf = LabelFrame(self.control, text="Curves to Plot", bg=COL_BG)
@@ -46,12 +57,22 @@ class main_panel(Frame) :
                                          ('Cancel', self.cancel_config))
         self.canvas_frame = Frame(self, bg=COL_BG, width=CANVAS_WIDTH, height=CANVAS_HEIGHT)
         self.canvas_frame.pack(side=RIGHT, expand=False)
-        self.canvas = None
+        self.figure = Figure()
+        self.canvas = FigureCanvasTkAgg(self.figure, master=self.canvas_frame)
+        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
+        self.graph_canvas = graph_canvas(self.canvas)
+        self.graph = None
+        self.busy_text = StringVar()
+        Label(self.control, textvariable=self.busy_text, bg=COL_BG, fg=COL_SELECT).pack(side=BOTTOM, anchor=W)
+        self.worker = plot_worker(self, PLOT_POLL_MS)
         self.operations = OrderedDict()
         for a in (("Plate Curves", plate_action),
                   ("Grid Curves", grid_action),
-                  ("Derivatives", deriv_action)) :
+                  ("Derivatives", deriv_action),
+                  ("Load Line", loadline_action),
+                  ("Derivative Map", map_action)) :
             self.operations[a[0]] = a[1](self.plot_params_frame, self.button_frame, self.get_tube_map)
+        self.operations["Load Line"].live_plot = self.live_plot
         for op in self.operations.iterkeys() :
             Radiobutton(lf, text = op, padx=GLOBAL_PADX, bg=COL_BG, \
                         variable=self.op, anchor=W, value=op, indicatoron=0 \
@@ -62,8 +83,45 @@ class main_panel(Frame) :
         self.current_action.install()
 
     def plot(self) :
-        if self.current_action :
-            self.show_graph(self.current_action.plot())
+        """
+        Calculate the curves in the background (see plot_worker), and show
+        the graph when they're ready. Any earlier plot still in progress is
+        cancelled.
+        """
+        action, tm = self.current_action, self.tube_map
+        if not (isinstance(action, plot_action) and tm) :
+            return
+        params = action.plot_params()
+        self.set_busy("Calculating %s..." % (tm.title,))
+        self.worker.submit(lambda: action.compute(tm, params),
+                           lambda result: self.plot_done(action, tm, params, result),
+                           self.plot_failed)
+
+    def live_plot(self, action) :
+        """
+        Called as the load line sliders move: if the action's graph is
+        showing, move its operating point and redraw just that, otherwise
+        plot it.
+        """
+        if action is not self.current_action :
+            return
+        if self.graph is not None and self.graph is action.graph :
+            action.update_point(self.tube_map)
+            self.graph_canvas.show(self.graph)
+        elif not self.worker.busy() :
+            self.plot()
+
+    def plot_done(self, action, tm, params, result) :
+        self.set_busy(None)
+        self.show_graph(action.make_graph(tm, params, result, self.graph, self.figure))
+
+    def plot_failed(self, exc) :
+        self.set_busy(None)
+        self.busy_text.set("Plot failed: %s" % (exc,))
+
+    def set_busy(self, message) :
+        self.busy_text.set(message or '')
+        self.master.config(cursor='watch' if message else '')
 
     def get_tube_map(self) :
         return self.tube_map
@@ -89,21 +147,32 @@ class main_panel(Frame) :
         self.current_action = action
         self.current_action.install()
 
+    def filter_change(self, *args) :
+        self.tube_records = self.catalog.find(self.data_source_text.get())
+        self.tube_list.delete(0, END)
+        for r in self.tube_records :
+            self.tube_list.insert(END, r['title'])
+
+    def tube_select(self, *args) :
+        selection = self.tube_list.curselection()
+        if selection :
+            self.install_tube_map(self.catalog.open(self.tube_records[int(selection[0])]))
+
     def data_change(self, *args) :
         utd = utracer_data(DATA_DIRECTORY + self.data_source.get())
-        self.tube_map = tube_map(utd, title=os.path.basename(self.data_source.get()).split('.')[0].upper())
+        self.install_tube_map(tube_map(utd, title=tube_catalog.make_title(self.data_source.get())))
+
+    def install_tube_map(self, tm) :
+        self.worker.cancel()
+        self.set_busy(None)
+        self.tube_map = tm
+        self.tube_map.enable_point_cache()
         for op in self.operations.values() :
             op.reset_data()
 
     def show_graph(self, graph) :
-        try :
-            self.canvas.get_tk_widget().delete("all")
-            self.canvas._tkcanvas.pack_forget()
-        except : pass
-        self.canvas = FigureCanvasTkAgg(graph.figure, master=self.canvas_frame)
-        self.canvas.show()
-        self.canvas.get_tk_widget().pack(side=TOP, fill=BOTH, expand=1)
-        self.canvas._tkcanvas.pack(side=RIGHT, fill=BOTH, expand=1)
+        self.graph = graph
+        self.graph_canvas.show(graph)
 
 if __name__=='__main__' :
     mp = main_panel()
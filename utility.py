@@ -1,7 +1,8 @@
 __all__ = [ 'round', 'cmpfn', 'flatten_reduce',
-            'flatten_min', 'flatten_max', 'x_from_y', 'pderiv', 'scale_list', 'camel_to_title',
+            'flatten_min', 'flatten_max', 'x_from_y', 'x_from_y_array', 'pderiv', 'scale_list', 'camel_to_title',
             'make_plural', 'make_singular', 'is_irregular_plural', 'make_indef_article',
-            'construct', 'add_default_arg', 'check_unused_args', 'contains_any', 'translate' ]
+            'construct', 'add_default_arg', 'check_unused_args', 'contains_any', 'translate',
+            'lru_cache', 'write_cache' ]
 
 import math
 import re
@@ -9,6 +10,7 @@ import os
 import sys
 import warnings
 import numpy as np
+from collections import OrderedDict
 
 #
 # round - round a number to the specified number of digits
@@ -69,7 +71,7 @@ def flatten_min(_list) :
 def flatten_max(_list) :
     return flatten_reduce(max, _list)
 
-def x_from_y(fn, bounds, y):
+def x_from_y(fn, bounds, y, max_iterations=100):
     '''
     Given a function (interpolation or actual function) and a y value, find the corresponding x value.
     Assumes the function is monotonic.
@@ -84,7 +86,9 @@ def x_from_y(fn, bounds, y):
         return xmin if asc else xmax
     if y > ymax :
         return xmax if asc else xmin
-    while not np.isclose(y, yn):
+    for i in xrange(max_iterations) :
+        if np.isclose(y, yn) :
+            break
         if (yn > y) ^ (not asc):
             xmax = x
             x = (xmin + x) / 2
@@ -94,6 +98,44 @@ def x_from_y(fn, bounds, y):
         yn = fn(x)
     return x
 
+def x_from_y_array(fn, bounds, y, rtol=1e-05, atol=1e-08, max_iterations=100):
+    '''
+    Array version of x_from_y: solve for all the y values at once, by bisection.
+    fn takes an array of x values the same shape as y and returns the corresponding
+    y values. bounds is (xmin, xmax), each either a scalar or an array matching y.
+    Targets outside the range of the function are clamped to the bounds, as for x_from_y.
+
+    Returns (x, failed), where failed is a boolean array marking the points where
+    fn(x) is not y (within rtol and atol, as for np.isclose): those outside the range,
+    and those which had not converged after max_iterations.
+    '''
+    y = np.asarray(y, dtype=float)
+    xmin = np.zeros(y.shape) + bounds[0]
+    xmax = np.zeros(y.shape) + bounds[1]
+    y0, y1 = fn(xmin), fn(xmax)
+    asc = y0 < y1
+    low = np.where(asc, xmin, xmax)         # x giving the lower y
+    high = np.where(asc, xmax, xmin)
+    below, above = y < np.minimum(y0, y1), y > np.maximum(y0, y1)
+    at_min = np.isclose(y, y0, rtol=rtol, atol=atol)
+    done = below | above | at_min
+    x = np.where(below, low, np.where(above, high, np.where(at_min, xmin, (xmin + xmax) / 2)))
+    for i in xrange(max_iterations) :
+        if done.all() :
+            break
+        yn = fn(x)
+        done |= np.isclose(y, yn, rtol=rtol, atol=atol)
+        down = ((yn > y) ^ (~asc)) & ~done
+        up = ~down & ~done
+        xmax = np.where(down, x, xmax)
+        xmin = np.where(up, x, xmin)
+        x = np.where(done, x, (xmin + xmax) / 2)
+    else :
+        done |= np.isclose(y, fn(x), rtol=rtol, atol=atol)
+    outside = (below & ~np.isclose(y, np.minimum(y0, y1), rtol=rtol, atol=atol)) | \
+              (above & ~np.isclose(y, np.maximum(y0, y1), rtol=rtol, atol=atol))
+    return x, ~done | outside
+
 def pderiv(fn, x, delta):
     '''
     Given a function, an x value, and dx, return dy/dx
@@ -337,3 +379,57 @@ def check_unused_args(kwargs) :
         raise NameError, "unexpected args: " + ", ".join(kwargs.keys())
             
     
+
+#
+# lru_cache - a dictionary-like cache holding at most size entries, which
+# discards the least recently used entry when it is full. A failed lookup
+# raises KeyError as for a dict. hits and misses count the lookups.
+#
+
+def write_cache(write, *args) :
+    '''
+    Call write(*args) to save a cache file. Caches only save time, so if the
+    file can't be written (e.g. the directory is read-only) it is just left out.
+    '''
+    try :
+        write(*args)
+    except (IOError, OSError) :
+        pass
+
+class lru_cache(object) :
+
+    def __init__(self, size) :
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def __getitem__(self, key) :
+        try :
+            value = self.entries.pop(key)
+        except KeyError :
+            self.misses += 1
+            raise
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value) :
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size :
+            self.entries.popitem(last=False)
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def clear(self) :
+        self.entries.clear()
+        self.hits = self.misses = 0
+
+    def stats(self) :
+        lookups = self.hits + self.misses
+        return { 'hits' : self.hits,
+                 'misses' : self.misses,
+                 'hit_rate' : float(self.hits) / lookups if lookups else 0.0,
+                 'entries' : len(self.entries),
+                 'size' : self.size }
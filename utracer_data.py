@@ -1,44 +1,131 @@
-import csv
 import os
 import re
+import hashlib
+import zipfile
+import numpy as np
+from utility import write_cache
 
 class utracer_data(object) :
-    
-    def __init__(self, filename) :
+    """
+    Parse a uTracer sweep file. The first line says which way round the
+    file is (Va or Vg down the left), the second gives the curve parameter
+    for each column, e.g. 'Vg = -2 V'. Everything after that is numeric
+    and is loaded as a single 2-D array.
+
+    Internally the axes and data are numpy arrays, always arranged with
+    one row per Va value and Vg ascending. get() returns fresh lists so
+    that callers can modify them freely.
+
+    The parsed arrays are cached in a sidecar file next to the source
+    (e.g. 6sn7.txt.npz). The cache records the source's mtime, size and
+    content hash: if the mtime and size still match it is used as is,
+    otherwise the source is hashed and the cache is rebuilt unless the
+    content is unchanged. Set utracer_data.use_cache to False (or pass
+    use_cache=False) to bypass it, and use purge_cache() to remove them.
+    """
+
+    ZERO_CLAMP = 0.001          # values smaller than this are treated as 0
+    CACHE_SUFFIX = '.npz'
+    CACHE_VERSION = 1           # change this if the parsed form changes
+    use_cache = True
+
+    def __init__(self, filename, use_cache=None) :
         self._make_filename(filename)
-        rowno = 1
+        if use_cache is None :
+            use_cache = utracer_data.use_cache
+        self.from_cache = use_cache and self._load_cache()
+        if not self.from_cache :
+            self._parse()
+            if use_cache :
+                self._save_cache()
+
+    def _parse(self) :
         with open(self.filename, 'rb') as f :
-            reader = csv.reader(f, delimiter=' ', skipinitialspace=True)
-            self.data = []
-            for row in reader :
-                if rowno==1:
-                    anode_down = 'Va' in row
-                else :
-                    if rowno == 2:
-                        row = ' '.join(' '.join(row).split())
-                        row = re.sub(r"V\w*\s*=\s*(\S*)\s*V", r"\1", row).split()
-                        row = [0] + row
-                    row = [float(r) for r in row if r]
-                    row = [r if abs(r) > 0.001 else 0 for r in row]
-                    self.data.append(row)
-                rowno += 1
-        if not anode_down :
-            r = [[ d[0] for d in self.data[1:]]]
-            for i,v in enumerate(zip(*self.data[1:])[1:]) :
-                r.append([self.data[0][i]] + list(v))
-            self.data = r
-        self.make_axes()
+            content = f.read()
+        self.content_hash = self._hash(content)
+        title, header, body = (content.split('\n', 2) + ['', ''])[:3]
+        anode_down = 'Va' in title.split()
+        axis = self._parse_header(header)
+        table = self._parse_body(body, len(axis) + 1)
+        self.make_axes(axis, table, anode_down)
         if self.vg[0] > self.vg[-1] :
             self.vg = self.vg[::-1]
-            self.data = [ d[::-1] for d in self.data ]
+            self.data = self.data[:, ::-1]
 
-    def make_axes(self):
-        self.vg = self.data[0]
-        self.va = [d[0] for d in self.data[1:]]
-        self.data = [d[1:] for d in self.data[1:]]
+    def make_axes(self, axis, table, anode_down) :
+        if anode_down :
+            self.va, self.vg, self.data = table[:, 0], axis, table[:, 1:]
+        else :
+            self.va, self.vg, self.data = axis, table[:, 0], table[:, 1:].T
 
     def get(self):
-        return (self.va, self.vg, self.data)
+        return (self.va.tolist(), self.vg.tolist(), self.data.tolist())
+
+    def _parse_header(self, header) :
+        row = re.sub(r"V\w*\s*=\s*(\S*)\s*V", r"\1", ' '.join(header.split())).split()
+        return self._clamp(np.array([float(r) for r in row]))
+
+    def _parse_body(self, body, columns) :
+        values = np.fromstring(body, sep=' ')
+        if values.size == 0 or values.size != len(body.split()) or values.size % columns :
+            raise ValueError("'%s' does not contain a %d column table" % (self.filename, columns))
+        return self._clamp(values.reshape(-1, columns))
+
+    def _clamp(self, values) :
+        return np.where(np.abs(values) > utracer_data.ZERO_CLAMP, values, 0.0)
+
+    def cache_filename(self) :
+        return self.filename + utracer_data.CACHE_SUFFIX
+
+    def _hash(self, content) :
+        return hashlib.sha1(content).hexdigest()
+
+    def _load_cache(self) :
+        """
+        Load the parsed arrays from the cache file, returning False if
+        there isn't one or it is stale.
+        """
+        st = os.stat(self.filename)
+        try :
+            with np.load(self.cache_filename()) as cache :
+                if int(cache['version']) != utracer_data.CACHE_VERSION :
+                    return False
+                self.content_hash = str(cache['hash'])
+                if (float(cache['mtime']), int(cache['size'])) != (st.st_mtime, st.st_size) :
+                    with open(self.filename, 'rb') as f :
+                        if self._hash(f.read()) != self.content_hash :
+                            return False
+                    touched = True
+                else :
+                    touched = False
+                self.va, self.vg, self.data = cache['va'], cache['vg'], cache['data']
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile) :
+            return False
+        if touched :
+            self._save_cache()          # same content, just record the new mtime
+        return True
+
+    def _save_cache(self) :
+        write_cache(self._write_cache)
+
+    def _write_cache(self) :
+        st = os.stat(self.filename)
+        with open(self.cache_filename(), 'wb') as f :
+            np.savez(f, version=utracer_data.CACHE_VERSION, hash=self.content_hash,
+                     mtime=st.st_mtime, size=st.st_size,
+                     va=self.va, vg=self.vg, data=self.data)
+
+    @staticmethod
+    def purge_cache(directory) :
+        """
+        Remove every sweep cache file in the directory. Return the number removed.
+        """
+        count = 0
+        for f in os.listdir(directory) :
+            if f.endswith(tuple(ext + utracer_data.CACHE_SUFFIX for ext in ('.txt', '.utd'))) :
+                os.remove(os.path.join(directory, f))
+                count += 1
+        return count
 
     def _make_filename(self, filename):
         if not (filename.endswith('.txt') or filename.endswith('.utd')) :
@@ -50,4 +137,90 @@ class utracer_data(object) :
         f.close()
         self.filename = filename
 
+# Test code - executed if the file is run stand-alone
+#
+# Compares the array parser against the original row-by-row csv parser,
+# for every file in the data directory (or the files given as arguments),
+# then checks that a round trip through the cache gives the same result.
+# Finally, a copy of each file with one row corrupted must be rejected.
+
+def legacy_get(filename) :
+    import csv
+    rowno = 1
+    with open(filename, 'rb') as f :
+        reader = csv.reader(f, delimiter=' ', skipinitialspace=True)
+        data = []
+        for row in reader :
+            if rowno==1:
+                anode_down = 'Va' in row
+            else :
+                if rowno == 2:
+                    row = ' '.join(' '.join(row).split())
+                    row = re.sub(r"V\w*\s*=\s*(\S*)\s*V", r"\1", row).split()
+                    row = [0] + row
+                row = [float(r) for r in row if r]
+                row = [r if abs(r) > 0.001 else 0 for r in row]
+                data.append(row)
+            rowno += 1
+    if not anode_down :
+        r = [[ d[0] for d in data[1:]]]
+        for i,v in enumerate(zip(*data[1:])[1:]) :
+            r.append([data[0][i]] + list(v))
+        data = r
+    vg = data[0]
+    va = [d[0] for d in data[1:]]
+    data = [d[1:] for d in data[1:]]
+    if vg[0] > vg[-1] :
+        vg = vg[::-1]
+        data = [ d[::-1] for d in data ]
+    return (va, vg, data)
+
+def t(filename) :
+    try :
+        expected = legacy_get(filename)
+    except ValueError :
+        expected = None
+    try :
+        actual = utracer_data(filename, use_cache=False).get()
+    except ValueError :
+        actual = None
+    if expected is None or actual is None :
+        ok = expected is None and actual is None
+        print '%-24s %s (both parsers reject the file)' % (filename, 'ok' if ok else 'FAIL')
+    else :
+        utracer_data(filename, use_cache=True)
+        cached = utracer_data(filename, use_cache=True)
+        ok = cached.from_cache and \
+             all(np.array_equal(np.array(e), np.array(a)) and np.array_equal(np.array(e), np.array(c))
+                 for e, a, c in zip(expected, actual, cached.get()))
+        print '%-24s %s (%d Va x %d Vg)' % (filename, 'ok' if ok else 'FAIL', len(actual[0]), len(actual[1]))
+    return ok
+
+def t_corrupt(filename) :
+    import tempfile
+    with open(filename, 'rb') as f :
+        lines = f.read().split('\n')
+    if len(lines) < 4 :
+        return True
+    row = len(lines) // 2
+    lines[row] = 'x' + lines[row].lstrip()
+    fd, corrupt = tempfile.mkstemp(suffix='.txt')
+    try :
+        with os.fdopen(fd, 'wb') as f :
+            f.write('\n'.join(lines))
+        try :
+            utracer_data(corrupt, use_cache=False)
+            ok = False
+        except ValueError :
+            ok = True
+    finally :
+        os.remove(corrupt)
+    print '%-24s %s (corrupt row %d rejected)' % (filename, 'ok' if ok else 'FAIL', row + 1)
+    return ok
 
+if __name__=="__main__" :
+    import sys
+    files = sys.argv[1:] or \
+            sorted(os.path.join('data', f) for f in os.listdir('data') if f.endswith(('.txt', '.utd')))
+    if not all([t(f) for f in files] + [t_corrupt(f) for f in files]) :
+        sys.exit(1)